@@ -0,0 +1,164 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Persistent caches of reward model scores (run_rm.py, run_bon.py) and judgements (run_generative.py)
+
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+# SQLite limits the number of parameters of one statement (999 in older versions)
+_MAX_QUERY_PARAMS = 500
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """
+    Fingerprint of everything in a tokenizer that changes the token ids of a formatted text:
+    the vocabulary and normalization / post-processing (which includes added BOS / EOS tokens) and truncation side.
+    """
+    h = hashlib.sha256()
+    if getattr(tokenizer, "is_fast", False):
+        h.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        h.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode("utf-8"))
+    settings = {
+        "truncation_side": tokenizer.truncation_side,
+        "add_bos_token": getattr(tokenizer, "add_bos_token", None),
+        "add_eos_token": getattr(tokenizer, "add_eos_token", None),
+    }
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ScoreCache:
+    """
+    SQLite key-value store of reward model scores. Scores are keyed by a namespace, built from the model id and
+    revision, the tokenizer fingerprint, the max length and any other `options` that change the scores (scoring
+    path, precision, ...), and by the hash of the formatted text, so a re-run (after a crash, on the pref sets after
+    the core set, or after a dataset revision) only scores new texts.
+    Scores are stored as JSON, so scalars and lists are both supported.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model_name: str,
+        revision: Optional[str] = None,
+        tokenizer=None,
+        max_length: Optional[int] = None,
+        options: Optional[Dict[str, Any]] = None,
+    ):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        key = {
+            "model": model_name,
+            "revision": revision,
+            "tokenizer": tokenizer_hash(tokenizer) if tokenizer is not None else None,
+            "max_length": max_length,
+            "options": options or {},
+        }
+        self.namespace = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        # several shards or jobs may share one cache file
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores (namespace TEXT NOT NULL, text_hash TEXT NOT NULL, "
+            "score TEXT NOT NULL, PRIMARY KEY (namespace, text_hash))"
+        )
+        self.connection.commit()
+
+    def get(self, texts: List[str]) -> List[Optional[Any]]:
+        """
+        Cached score of every text, None for cache misses.
+        """
+        hashes = [hash_text(text) for text in texts]
+        found = {}
+        for start in range(0, len(hashes), _MAX_QUERY_PARAMS):
+            chunk = list(set(hashes[start : start + _MAX_QUERY_PARAMS]))
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT text_hash, score FROM scores WHERE namespace = ? AND text_hash IN ({placeholders})",
+                [self.namespace] + chunk,
+            )
+            found.update((text_hash, json.loads(score)) for text_hash, score in rows)
+        return [found.get(text_hash) for text_hash in hashes]
+
+    def put(self, texts: List[str], scores: List[Any]):
+        assert len(texts) == len(scores), "one score per text"
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores (namespace, text_hash, score) VALUES (?, ?, ?)",
+            [(self.namespace, hash_text(text), json.dumps(score)) for text, score in zip(texts, scores)],
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class JudgementCache:
+    """
+    SQLite store of generative judge outputs, keyed by the hash of the judge model, system prompt, formatted user
+    prompt and sampling parameters. The raw judgement text is stored next to the parsed winner, so re-runs and
+    re-scoring with another parser (e.g. an updated `process_judgement`) do not query the judge again.
+    """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS judgements (key TEXT PRIMARY KEY NOT NULL, model TEXT NOT NULL, "
+            "judgement TEXT NOT NULL, winner TEXT)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(model: str, system_prompt: str, user_prompt: str, sampling_params: Dict) -> str:
+        key = [model, system_prompt, user_prompt, sampling_params]
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, model: str, system_prompt: str, user_prompt: str, sampling_params: Dict) -> Optional[str]:
+        """
+        Raw judgement text, None for cache misses.
+        """
+        row = self.connection.execute(
+            "SELECT judgement FROM judgements WHERE key = ?",
+            (self.key(model, system_prompt, user_prompt, sampling_params),),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def put(
+        self,
+        model: str,
+        system_prompt: str,
+        user_prompt: str,
+        sampling_params: Dict,
+        judgement: str,
+        winner: Optional[str] = None,
+    ):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO judgements (key, model, judgement, winner) VALUES (?, ?, ?, ?)",
+            (self.key(model, system_prompt, user_prompt, sampling_params), model, judgement, winner),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
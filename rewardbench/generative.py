@@ -16,13 +16,26 @@
 # pip install openai>=1.0
 # pip install anthropic>=0.21.3
 
+import asyncio
+import json
+import math
 import os
+import random
+import re
 import time as time
+from urllib.parse import urlparse
 
 import anthropic
 import openai
+import torch
 from fastchat.conversation import get_conv_template
 from openai import OpenAI
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
 
 ANTHROPIC_MODEL_LIST = (
     "claude-1",
@@ -56,8 +69,29 @@ API_MODEL_LIST = OPENAI_MODEL_LIST + ANTHROPIC_MODEL_LIST
 # API setting constants
 API_MAX_RETRY = 16
 API_RETRY_SLEEP = 10
+API_MAX_RETRY_SLEEP = 120
 API_ERROR_OUTPUT = "$ERROR$"
 
+
+def retry_sleep_time(attempt, retry_after=None):
+    """
+    Exponential backoff with full jitter, API_RETRY_SLEEP * 2^attempt capped at API_MAX_RETRY_SLEEP,
+    or the server's `retry-after` if it is longer.
+    """
+    sleep = random.uniform(0, min(API_MAX_RETRY_SLEEP, API_RETRY_SLEEP * 2**attempt))
+    if retry_after is not None:
+        try:
+            sleep = max(sleep, float(retry_after))
+        except ValueError:
+            pass
+    return sleep
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    return response.headers.get("retry-after") if response is not None else None
+
+
 prompt_v2 = (
     "Please act as an impartial judge and evaluate the quality of the responses provided by two AI assistants to the user question displayed below. "  # noqa
     "You should choose the assistant that follows the user's instructions and answers the user's question better. Your evaluation should consider "  # noqa
@@ -139,12 +173,32 @@ def process_judgement(judgment):
         return "error"
 
 
+# opening of the verdict in the output format, the verdict token follows it
+VERDICT_PREFIX = "[["
+
+
+def process_verdict_logprobs(token_logprobs):
+    """
+    Probability that assistant A is better, from the log probabilities of the verdict token after a forced
+    `VERDICT_PREFIX`. `token_logprobs` are (decoded token, log probability) pairs, e.g. the top-k of that position;
+    the mass of the tokens reading "A" and "B" is renormalized, 0.5 only if neither is among them.
+    """
+    mass = {"A": 0.0, "B": 0.0}
+    for token, logprob in token_logprobs:
+        token = token.strip()
+        if token in mass:
+            mass[token] += math.exp(logprob)
+    total = mass["A"] + mass["B"]
+    return mass["A"] / total if total > 0 else 0.5
+
+
 # noqa adapted from FastChat https://github.com/lm-sys/FastChat/blob/b015f21cb9d0cf3c87d2a5e53008074c537e8be0/fastchat/llm_judge/common.py#L235C1-L312C1
-def run_judge_pair(question, answer_a, answer_b, model, multi_turn=False):
+def run_judge_pair(question, answer_a, answer_b, model, multi_turn=False, api_dict=None):
     system_prompt, user_prompt = format_judge_answers(question, answer_a, answer_b, multi_turn)
     winner = "error"
 
-    if model in OPENAI_MODEL_LIST:
+    # an `api_base` in api_dict selects an OpenAI-compatible server (vLLM, llama.cpp, TGI) serving `model`
+    if model in OPENAI_MODEL_LIST or (api_dict is not None and api_dict.get("api_base") is not None):
         template = "chatgpt"
         conv = get_conv_template(template)
 
@@ -152,7 +206,7 @@ def run_judge_pair(question, answer_a, answer_b, model, multi_turn=False):
         conv.append_message(conv.roles[1], None)
         conv.set_system_message(system_prompt)
 
-        judgment = chat_completion_openai(model, conv, temperature=0, max_tokens=2048)
+        judgment = chat_completion_openai(model, conv, temperature=0, max_tokens=2048, api_dict=api_dict)
     elif model in ANTHROPIC_MODEL_LIST:
         template = "claude"
         conv = get_conv_template(template)
@@ -170,6 +224,14 @@ def run_judge_pair(question, answer_a, answer_b, model, multi_turn=False):
     return winner, user_prompt, judgment
 
 
+def api_max_tokens(model, base_url=None):
+    # completion budget of the judges, as in `run_judge_pair`: models behind an OpenAI-compatible `base_url` get the
+    # budget of OpenAI models, so a judge truncates the same way in the sync and async paths
+    if model in OPENAI_MODEL_LIST or (base_url is not None and model not in ANTHROPIC_MODEL_LIST):
+        return 2048
+    return 1024
+
+
 # also uses ArenaHard code
 # noqa https://github.com/lm-sys/arena-hard/blob/51c04e5a6449e920c01d4159f56a051216af6bd9/utils.py#L166
 def chat_completion_anthropic(model, conv, temperature, max_tokens, api_dict=None):
@@ -184,9 +246,9 @@ def chat_completion_anthropic(model, conv, temperature, max_tokens, api_dict=Non
         conv.messages = conv.messages[1:]
 
     output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+    c = anthropic.Anthropic(api_key=api_key)
+    for attempt in range(API_MAX_RETRY):
         try:
-            c = anthropic.Anthropic(api_key=api_key)
             response = c.messages.create(
                 model=model,
                 messages=conv.messages,
@@ -199,14 +261,31 @@ def chat_completion_anthropic(model, conv, temperature, max_tokens, api_dict=Non
             break
         except anthropic.APIError as e:
             print(type(e), e)
-            time.sleep(API_RETRY_SLEEP)
+            time.sleep(retry_sleep_time(attempt, _retry_after(e)))
     return output.strip()
 
 
+def openai_api_key(base_url=None, api_key=None):
+    # local OpenAI-compatible servers usually accept any key
+    return api_key or os.environ.get("OPENAI_API_KEY") or ("EMPTY" if base_url is not None else None)
+
+
+_OPENAI_CLIENTS = {}
+
+
+def _openai_client(base_url=None, api_key=None):
+    # one client (and keep-alive connection pool) per endpoint, instead of a new client per request
+    api_key = openai_api_key(base_url, api_key)
+    if (base_url, api_key) not in _OPENAI_CLIENTS:
+        _OPENAI_CLIENTS[(base_url, api_key)] = OpenAI(base_url=base_url, api_key=api_key)
+    return _OPENAI_CLIENTS[(base_url, api_key)]
+
+
 def chat_completion_openai(model, conv, temperature, max_tokens, api_dict=None):
-    client = OpenAI()
+    api_dict = api_dict or {}
+    client = _openai_client(api_dict.get("api_base"), api_dict.get("api_key"))
     output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+    for attempt in range(API_MAX_RETRY):
         try:
             messages = conv.to_openai_api_messages()
             response = client.chat.completions.create(
@@ -214,19 +293,432 @@ def chat_completion_openai(model, conv, temperature, max_tokens, api_dict=None):
             )
             output = response.choices[0].message.content
             break
-        except openai.APIError as e:
-            # Handle API error here, e.g. retry or log
-            print(f"OpenAI API returned an API Error: {e}")
-            time.sleep(API_RETRY_SLEEP)
+        except openai.RateLimitError as e:
+            # Handle rate limit error with exponential backoff
+            print(f"OpenAI API request exceeded rate limit: {e}")
+            time.sleep(retry_sleep_time(attempt, _retry_after(e)))
 
         except openai.APIConnectionError as e:
             # Handle connection error here
             print(f"Failed to connect to OpenAI API: {e}")
-            time.sleep(API_RETRY_SLEEP)
+            time.sleep(retry_sleep_time(attempt))
 
-        except openai.RateLimitError as e:
-            # Handle rate limit error (we recommend using exponential backoff)
-            print(f"OpenAI API request exceeded rate limit: {e}")
-            time.sleep(API_RETRY_SLEEP)
+        except openai.APIError as e:
+            # Handle API error here, e.g. retry or log
+            print(f"OpenAI API returned an API Error: {e}")
+            time.sleep(retry_sleep_time(attempt, _retry_after(e)))
 
     return output
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket refilled continuously at `rate_per_minute`, holding at most one minute of capacity.
+    `acquire(amount)` waits until `amount` tokens (requests, or prompt + completion tokens) are available.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)  # larger requests could never be served
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit with additive increase (+1 per limit's worth of successes) and multiplicative decrease
+    (halved on every rate limit error), so the number of requests in flight tracks what the provider accepts.
+    """
+
+    def __init__(self, max_concurrency, initial_concurrency=None):
+        self.max_concurrency = max_concurrency
+        self.limit = float(initial_concurrency or max(1, max_concurrency // 4))
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def on_success(self):
+        async with self.condition:
+            capacity = int(self.limit)
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            # wake the tasks waiting for the added slots, not only those of finished requests
+            if int(self.limit) > capacity:
+                self.condition.notify(int(self.limit) - capacity)
+
+    def on_rate_limit(self):
+        self.limit = max(1.0, self.limit / 2)
+
+
+class AsyncJudgeClient:
+    """
+    Asyncio client for API judges (OpenAI and Anthropic models), sharing one pooled HTTP client for all requests.
+    Requests are paced by token buckets on requests and tokens per minute, the number in flight adapts with AIMD
+    to rate limit (429) errors, and failed requests are retried with exponential backoff and jitter.
+    With `base_url`, any model served by an OpenAI-compatible server (vLLM, llama.cpp, TGI) can be used as judge.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_concurrency=64,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        base_url=None,
+        api_key=None,
+    ):
+        self.model = model
+        # `base_url` also points Anthropic models to another server, e.g. the mock judge server
+        self.is_openai = model in OPENAI_MODEL_LIST or (base_url is not None and model not in ANTHROPIC_MODEL_LIST)
+        if self.is_openai:
+            self.client = openai.AsyncOpenAI(
+                base_url=base_url, api_key=openai_api_key(base_url, api_key), max_retries=0
+            )
+            self.rate_limit_errors = (openai.RateLimitError,)
+            self.api_errors = (openai.APIError,)
+        elif model in ANTHROPIC_MODEL_LIST:
+            self.client = anthropic.AsyncAnthropic(
+                api_key=api_key or os.environ["ANTHROPIC_API_KEY"], base_url=base_url, max_retries=0
+            )
+            self.rate_limit_errors = (anthropic.RateLimitError,)
+            self.api_errors = (anthropic.APIError,)
+        else:
+            raise ValueError(f"Model {model} not supported")
+        self.max_tokens = api_max_tokens(model, base_url)
+        self.limiter = AIMDLimiter(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # statistics, e.g. for benchmarks
+        self.num_rate_limits = 0
+        self.num_retries = 0
+
+    async def _create(self, system_prompt, user_prompt, temperature, max_tokens):
+        if self.is_openai:
+            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+            response = await self.client.chat.completions.create(
+                model=self.model, messages=messages, n=1, temperature=temperature, max_tokens=max_tokens
+            )
+            return response.choices[0].message.content
+        else:
+            response = await self.client.messages.create(
+                model=self.model,
+                messages=[{"role": "user", "content": user_prompt}],
+                stop_sequences=[anthropic.HUMAN_PROMPT],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system=system_prompt,
+            )
+            return response.content[0].text.strip()
+
+    async def judge(self, system_prompt, user_prompt, temperature=0, max_tokens=2048):
+        """
+        Returns the judge's answer, or API_ERROR_OUTPUT after API_MAX_RETRY failed attempts.
+        """
+        # about 4 characters per token, the completion is counted at its maximum length
+        num_tokens = (len(system_prompt) + len(user_prompt)) // 4 + max_tokens
+        for attempt in range(API_MAX_RETRY):
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(num_tokens)
+            try:
+                async with self.limiter:
+                    output = await self._create(system_prompt, user_prompt, temperature, max_tokens)
+                await self.limiter.on_success()
+                return output
+            except self.rate_limit_errors as e:
+                self.limiter.on_rate_limit()
+                self.num_rate_limits += 1
+                self.num_retries += 1
+                await asyncio.sleep(retry_sleep_time(attempt, _retry_after(e)))
+            except self.api_errors as e:
+                print(type(e), e)
+                self.num_retries += 1
+                await asyncio.sleep(retry_sleep_time(attempt, _retry_after(e)))
+        return API_ERROR_OUTPUT
+
+    async def close(self):
+        await self.client.close()
+
+
+async def run_judge_pair_async(question, answer_a, answer_b, client, multi_turn=False, cache=None):
+    """
+    Asyncio version of `run_judge_pair` for API models, with an `AsyncJudgeClient`.
+    With a `JudgementCache`, cached judgements are re-parsed instead of sent to the API.
+    """
+    system_prompt, user_prompt = format_judge_answers(question, answer_a, answer_b, multi_turn)
+    sampling_params = {"temperature": 0, "max_tokens": client.max_tokens}
+
+    judgment = cache.get(client.model, system_prompt, user_prompt, sampling_params) if cache is not None else None
+    if judgment is None:
+        judgment = await client.judge(system_prompt, user_prompt, **sampling_params)
+        if cache is not None and judgment != API_ERROR_OUTPUT:
+            cache.put(client.model, system_prompt, user_prompt, sampling_params, judgment, process_judgement(judgment))
+    winner = process_judgement(judgment)
+    return winner, user_prompt, judgment
+
+
+class JudgementLog:
+    """
+    Append-only JSONL log of finished judgements (one record per line, with at least the example `index`),
+    flushed as each judgement arrives so a crashed or interrupted run can be resumed without re-sending requests.
+    With `resume`, the records of a previous run are loaded, except failed API calls, which are judged again.
+    Without it, a log that already holds judgements is only replaced with `overwrite`.
+    """
+
+    def __init__(self, path, resume=False, overwrite=False):
+        self.records = {}
+        if not resume and not overwrite and os.path.isfile(path) and os.path.getsize(path) > 0:
+            raise FileExistsError(
+                f"Judgement log {path} already holds judgements, pass --resume to continue it "
+                "or --overwrite_log to replace it"
+            )
+        if resume and os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # line cut off by the crash
+                        continue
+                    if record.get("judgement") != API_ERROR_OUTPUT:
+                        self.records[record["index"]] = record
+            print(f"Resuming from {len(self.records)} judgements in {path}")
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a" if resume else "w")
+        if resume and self.file.tell() > 0:
+            self.file.write("\n")  # terminate a possibly cut off last line, empty lines are skipped on resume
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def judgement_log_path(model, pref_sets=False, debug=False, seed=42, base_url=None, log_dir="results/judgement-logs"):
+    # default log of a run, distinct per data, seed and server so a debug run never collides with a full one
+    name = f"{model}-seed{seed}"
+    if base_url is not None:
+        name += "-" + re.sub(r"[^A-Za-z0-9.]+", "-", urlparse(base_url).netloc)
+    if debug:
+        name += "-debug"
+    return os.path.join(log_dir, "pref-sets" if pref_sets else "eval-set", f"{name}.jsonl")
+
+
+def batch_custom_id(index, is_shuffled):
+    # the request id carries the example index and the A/B order, so results can be ingested in any order
+    return f"rewardbench-{index}-{'BA' if is_shuffled else 'AB'}"
+
+
+def parse_batch_custom_id(custom_id):
+    _, index, order = custom_id.rsplit("-", 2)
+    return int(index), order == "BA"
+
+
+def format_batch_request(custom_id, model, system_prompt, user_prompt):
+    """
+    One line of a provider batch file (OpenAI Batch API or Anthropic Message Batches), with the same messages and
+    sampling parameters as the requests of `AsyncJudgeClient`.
+    """
+    if model in OPENAI_MODEL_LIST:
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": messages,
+                "n": 1,
+                "temperature": 0,
+                "max_tokens": api_max_tokens(model),
+            },
+        }
+    elif model in ANTHROPIC_MODEL_LIST:
+        return {
+            "custom_id": custom_id,
+            "params": {
+                "model": model,
+                "messages": [{"role": "user", "content": user_prompt}],
+                "stop_sequences": [anthropic.HUMAN_PROMPT],
+                "max_tokens": api_max_tokens(model),
+                "temperature": 0,
+                "system": system_prompt,
+            },
+        }
+    else:
+        raise ValueError(f"Model {model} not supported")
+
+
+def parse_batch_result(result):
+    """
+    Custom id and judgement of one line of a provider batch results file, API_ERROR_OUTPUT for failed requests.
+    """
+    custom_id = result["custom_id"]
+    if "response" in result:  # OpenAI
+        response = result["response"]
+        if result.get("error") or response is None or response["status_code"] != 200:
+            return custom_id, API_ERROR_OUTPUT
+        return custom_id, response["body"]["choices"][0]["message"]["content"]
+    else:  # Anthropic
+        outcome = result["result"]
+        if outcome["type"] != "succeeded":
+            return custom_id, API_ERROR_OUTPUT
+        return custom_id, outcome["message"]["content"][0]["text"].strip()
+
+
+def load_batch_results(path):
+    """
+    Read a provider batch results file, returns {example index: (is_shuffled, judgement)}.
+    """
+    judgements = {}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            custom_id, judgement = parse_batch_result(json.loads(line))
+            index, is_shuffled = parse_batch_custom_id(custom_id)
+            judgements[index] = (is_shuffled, judgement)
+    return judgements
+
+
+def truncate_at_stop(text, stop=None):
+    """
+    Cut a generation after the first stop string it contains, the stop string is kept.
+    """
+    ends = [text.index(s) + len(s) for s in (stop or []) if s in text]
+    return text[: min(ends)] if ends else text
+
+
+class StopOnStrings(StoppingCriteria):
+    """
+    Stops `generate` once every row of the batch has generated one of the stop strings (e.g. the "]]" closing a
+    verdict), only the last few new tokens of each row are decoded per step.
+    """
+
+    def __init__(self, tokenizer, stop, prompt_length, window=8):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.prompt_length = prompt_length
+        self.window = window
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool)
+        start = max(self.prompt_length, input_ids.shape[1] - self.window)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        for i, tail in enumerate(tails):
+            self.done[i] |= any(s in tail for s in self.stop)
+        # rows that stopped early are cut with `truncate_at_stop`
+        return bool(self.done.all())
+
+
+class TransformersJudge:
+    """
+    Local judge running HF transformers `generate`, for machines without vLLM (CPU boxes, CI).
+    Prompts are sorted by length and run in left-padded batches of `batch_size` with greedy decoding and the KV
+    cache; generation of a batch ends when every row has produced a stop string or an end of sequence token.
+    """
+
+    def __init__(self, model_name, batch_size=8, trust_remote_code=False, device=None):
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            model_name, padding_side="left", trust_remote_code=trust_remote_code
+        )
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            trust_remote_code=trust_remote_code,
+            torch_dtype=torch.bfloat16 if device != "cpu" else torch.float32,
+        )
+        self.model.to(device).eval()
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+
+    def _batches(self, prompts):
+        # the chat formatted prompts already contain the special tokens
+        input_ids = self.tokenizer(prompts, add_special_tokens=False)["input_ids"]
+        # length-bucketed batches, longest first, so little padding is computed
+        order = sorted(range(len(prompts)), key=lambda i: len(input_ids[i]), reverse=True)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            inputs = self.tokenizer.pad({"input_ids": [input_ids[i] for i in indices]}, return_tensors="pt")
+            yield indices, {k: v.to(self.device) for k, v in inputs.items()}
+
+    def _eos_token_ids(self, stop_token_ids=None):
+        return [self.tokenizer.eos_token_id] + list(stop_token_ids or [])
+
+    def generate(self, prompts, max_new_tokens=1024, stop=None, stop_token_ids=None):
+        """
+        Greedy completions of `prompts` in input order, cut after the first stop string.
+        """
+        outputs = [None] * len(prompts)
+        for indices, inputs in self._batches(prompts):
+            prompt_length = inputs["input_ids"].shape[1]
+            stopping_criteria = None
+            if stop:
+                stopping_criteria = StoppingCriteriaList([StopOnStrings(self.tokenizer, stop, prompt_length)])
+            with torch.no_grad():
+                output_ids = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    eos_token_id=self._eos_token_ids(stop_token_ids),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    stopping_criteria=stopping_criteria,
+                )
+            texts = self.tokenizer.batch_decode(output_ids[:, prompt_length:], skip_special_tokens=True)
+            for i, text in zip(indices, texts):
+                outputs[i] = truncate_at_stop(text, stop)
+        return outputs
+
+    def verdict_probabilities(self, prompts, top_k=20):
+        """
+        Probability that assistant A is better for prompts ending with `VERDICT_PREFIX`, from the top `top_k`
+        log probabilities of the next token (see `process_verdict_logprobs`).
+        """
+        probs = [None] * len(prompts)
+        for indices, inputs in self._batches(prompts):
+            with torch.no_grad():
+                # one generation step only computes the logits of the last position
+                output = self.model.generate(
+                    **inputs,
+                    max_new_tokens=1,
+                    do_sample=False,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    output_scores=True,
+                    return_dict_in_generate=True,
+                )
+            top = output.scores[0].float().log_softmax(dim=-1).topk(top_k, dim=-1)
+            for i, logprobs, token_ids in zip(indices, top.values.tolist(), top.indices.tolist()):
+                probs[i] = process_verdict_logprobs(
+                    (self.tokenizer.decode([token_id]), logprob) for token_id, logprob in zip(token_ids, logprobs)
+                )
+        return probs
@@ -0,0 +1,175 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local stand-in for the judge APIs, to test and benchmark the generative pipeline without paying for requests
+
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+CANNED_JUDGEMENTS = (
+    "Assistant A follows the instructions and answers the question more accurately.\n\n[[A]]",
+    "Assistant B follows the instructions and answers the question more accurately.\n\n[[B]]",
+)
+
+
+class MockJudgeServer:
+    """
+    HTTP server speaking the OpenAI chat completions (`/v1/chat/completions`) and Anthropic messages
+    (`/v1/messages`) APIs. Every request is answered after `latency` seconds (plus uniform jitter up to
+    `latency_jitter`) with one of `judgements`, picked by the hash of the messages so repeated prompts get the same
+    answer. A fraction `rate_limit_prob` of the requests is rejected with a 429, with a `retry-after` header if
+    `retry_after` is set.
+
+    Use as a context manager, the OpenAI base url is `server.url + "/v1"` and the Anthropic one `server.url`.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        latency_jitter: float = 0.0,
+        rate_limit_prob: float = 0.0,
+        retry_after: Optional[float] = None,
+        judgements: List[str] = CANNED_JUDGEMENTS,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.judgements = list(judgements)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_rate_limited = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sample(self):
+        # (sleep, rate limited), the shared generator is not thread safe
+        with self.lock:
+            self.num_requests += 1
+            sleep = self.latency + self.rng.uniform(0, self.latency_jitter)
+            rate_limited = self.rng.random() < self.rate_limit_prob
+            if rate_limited:
+                self.num_rate_limited += 1
+        return sleep, rate_limited
+
+    def judgement(self, messages) -> str:
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()
+        return self.judgements[digest[0] % len(self.judgements)]
+
+
+def _make_handler(server: MockJudgeServer):
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive connections, as the real APIs
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            is_openai = self.path.endswith("/chat/completions")
+            if not is_openai and not self.path.endswith("/messages"):
+                self._send_json(404, {"error": {"type": "not_found_error", "message": f"Unknown path {self.path}"}})
+                return
+
+            sleep, rate_limited = server._sample()
+            time.sleep(sleep)
+            if rate_limited:
+                message = "Rate limit reached (mock judge server)"
+                if is_openai:
+                    body = {"error": {"type": "requests", "code": "rate_limit_exceeded", "message": message}}
+                else:
+                    body = {"type": "error", "error": {"type": "rate_limit_error", "message": message}}
+                headers = {"retry-after": str(server.retry_after)} if server.retry_after is not None else None
+                self._send_json(429, body, headers)
+                return
+
+            messages = request.get("messages", [])
+            text = server.judgement([request.get("system", "")] + messages)
+            # rough token counts, about 4 characters per token
+            prompt_tokens = len(json.dumps(messages)) // 4
+            completion_tokens = len(text) // 4
+            if is_openai:
+                body = {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                            "logprobs": None,
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                }
+            else:
+                body = {
+                    "id": "msg_mock",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": request.get("model", "mock"),
+                    "content": [{"type": "text", "text": text}],
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+                }
+            self._send_json(200, body)
+
+    return Handler
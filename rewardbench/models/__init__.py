@@ -23,6 +23,7 @@ from transformers import (
     pipeline,
 )
 
+from .base import RewardPipeline, SequenceClassifierPipeline  # noqa
 from .beaver import BeaverCostPipeline, BeaverPipeline, LlamaForScore
 from .betterpairrm import BetterPairRMPipeline
 from .openassistant import *  # noqa
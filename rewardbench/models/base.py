@@ -0,0 +1,256 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Base class for custom reward model pipelines
+
+from typing import Dict, List, Mapping, Optional, Tuple, Union
+
+import torch
+from transformers import PreTrainedModel, PreTrainedTokenizer
+
+from .utils import AdaptiveBatcher, gather_token_states
+
+
+def fork_cache(past_key_values, repeats: int):
+    """
+    Repeat every row of a KV cache `repeats` times, so several continuations attend to one encoded prefix.
+    Supports `Cache` objects and the legacy tuple of (key, value) tensors per layer.
+    """
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(tuple(t.repeat_interleave(repeats, dim=0) for t in layer) for layer in past_key_values)
+
+
+class RewardPipeline:
+    """
+    Base class for custom pipelines that return one score per sample.
+
+    Following the HuggingFace pipelines, work is split into `preprocess` (tokenization, CPU only and safe to run in
+    DataLoader workers) and `_forward` (the model call on a padded batch on the model device).
+    A pipeline can be called with raw texts or with pre-tokenized inputs, i.e. a mapping with `input_ids`
+    and optionally `attention_mask`, either as lists of unpadded token ids (the output of `preprocess`) or as
+    padded tensors.
+
+    Decoder-only pipelines can also implement `_decoder` and `_head` to score chosen / rejected pairs with
+    `score_pairs`, which encodes the shared prompt once and continues both responses from its KV cache.
+    """
+
+    def __init__(self, task, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
+        self.task = task
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batcher = AdaptiveBatcher()
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    def preprocess(self, samples: List[str], **kwargs) -> Dict[str, List[List[int]]]:
+        """
+        Tokenize texts without padding, padding is done per micro-batch when scoring.
+        """
+        truncation = kwargs.get("truncation", True)
+        max_length = kwargs.get("max_length", 2048)
+        encodings = self.tokenizer(samples, truncation=truncation, max_length=max_length)
+        return {"input_ids": encodings["input_ids"], "attention_mask": encodings["attention_mask"]}
+
+    def _forward(self, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Score a padded batch already on the model device, returns one row per sample.
+        """
+        raise NotImplementedError
+
+    def _decoder(self) -> Optional[PreTrainedModel]:
+        """
+        Transformer body of the model (returning `last_hidden_state` and `past_key_values`) for `score_pairs`,
+        None if shared prefix scoring is not supported.
+        """
+        return None
+
+    def _head(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """
+        Score the hidden states of the pooled tokens, (B, E), with the same output as `_forward`.
+        """
+        raise NotImplementedError
+
+    def _pool_index(self, input_ids: List[int]) -> int:
+        """
+        Position of the token the reward head is read at, the last token by default.
+        """
+        return len(input_ids) - 1
+
+    @property
+    def supports_shared_prefix(self) -> bool:
+        return self._decoder() is not None
+
+    def __call__(self, samples: Union[List[str], Mapping], **kwargs) -> torch.Tensor:
+        encodings = self.to_encodings(samples, **kwargs)
+        return self.score(encodings, batch_size=kwargs.get("batch_size", 1), padding=kwargs.get("padding", True))
+
+    def to_encodings(self, samples: Union[List[str], Mapping], **kwargs) -> Dict[str, List[List[int]]]:
+        """
+        Return unpadded token ids, tokenizing raw texts and stripping the padding of tensor inputs.
+        """
+        if not isinstance(samples, Mapping):
+            return self.preprocess(samples, **kwargs)
+
+        input_ids = samples["input_ids"]
+        attention_mask = samples.get("attention_mask", None)
+        if isinstance(input_ids, torch.Tensor):
+            if attention_mask is None:
+                attention_mask = torch.ones_like(input_ids)
+            input_ids = [ids[mask.bool()].tolist() for ids, mask in zip(input_ids.cpu(), attention_mask.cpu())]
+        return {"input_ids": input_ids, "attention_mask": [[1] * len(ids) for ids in input_ids]}
+
+    def score(self, encodings: Dict[str, List[List[int]]], batch_size: int = 1, padding=True) -> torch.Tensor:
+        """
+        Run `_forward` over length-sorted, OOM-adaptive micro-batches, returns the scores in input order.
+        """
+        device = self.device
+
+        def forward(indices):
+            inputs = self.tokenizer.pad(
+                {k: [v[i] for i in indices] for k, v in encodings.items()}, padding=padding, return_tensors="pt"
+            )
+            if device.type == "cuda":
+                # page-locked host buffers allow asynchronous copies to the GPU
+                inputs = {k: v.pin_memory() for k, v in inputs.items()}
+            inputs = {k: v.to(device, non_blocking=True) for k, v in inputs.items()}
+            with torch.no_grad():
+                return self._forward(inputs)
+
+        return self.batcher(forward, [len(ids) for ids in encodings["input_ids"]], batch_size)
+
+    def score_pairs(
+        self, chosen: Union[List[str], Mapping], rejected: Union[List[str], Mapping], **kwargs
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Score chosen and rejected samples that share a prompt, returns the scores of both in input order.
+
+        The shared prefix of every pair is its longest common token prefix (the chat-formatted prompt), which is
+        encoded once; its KV cache is forked for the two responses, and the head is read at each response's pooled
+        token. Pairs without a common prefix (e.g. after left truncation) are scored independently.
+        """
+        encodings_chosen = self.to_encodings(chosen, **kwargs)
+        encodings_rejected = self.to_encodings(rejected, **kwargs)
+        batch_size = kwargs.get("batch_size", 1)
+        decoder = self._decoder()
+        assert decoder is not None, f"{type(self).__name__} does not support shared prefix scoring"
+
+        ids_chosen, ids_rejected = encodings_chosen["input_ids"], encodings_rejected["input_ids"]
+        pool_chosen = [self._pool_index(ids) for ids in ids_chosen]
+        pool_rejected = [self._pool_index(ids) for ids in ids_rejected]
+        # the pooled tokens must be part of the responses, not of the shared prefix
+        prefix_lengths = []
+        for c, r, limit in zip(ids_chosen, ids_rejected, map(min, pool_chosen, pool_rejected)):
+            length = 0
+            while length < limit and c[length] == r[length]:
+                length += 1
+            prefix_lengths.append(length)
+
+        shared = [i for i, length in enumerate(prefix_lengths) if length > 0]
+        unshared = [i for i, length in enumerate(prefix_lengths) if length == 0]
+        device = self.device
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+        def forward(indices):
+            pairs = [shared[i] for i in indices]
+            prefixes = [ids_chosen[i][: prefix_lengths[i]] for i in pairs]
+            suffixes, pooled = [], []
+            for i in pairs:
+                suffixes += [ids_chosen[i][prefix_lengths[i] :], ids_rejected[i][prefix_lengths[i] :]]
+                pooled += [pool_chosen[i] - prefix_lengths[i], pool_rejected[i] - prefix_lengths[i]]
+            prefix_len = max(len(ids) for ids in prefixes)
+            suffix_len = max(len(ids) for ids in suffixes)
+
+            # left pad the prefixes and right pad the responses, so every response directly follows its prompt
+            prefix_ids = torch.tensor([[pad_id] * (prefix_len - len(ids)) + ids for ids in prefixes])
+            prefix_mask = torch.tensor([[0] * (prefix_len - len(ids)) + [1] * len(ids) for ids in prefixes])
+            suffix_ids = torch.tensor([ids + [pad_id] * (suffix_len - len(ids)) for ids in suffixes])
+            suffix_mask = torch.tensor([[1] * len(ids) + [0] * (suffix_len - len(ids)) for ids in suffixes])
+            prefix_ids, prefix_mask = prefix_ids.to(device), prefix_mask.to(device)
+            suffix_ids, suffix_mask = suffix_ids.to(device), suffix_mask.to(device)
+
+            with torch.no_grad():
+                prefix_outputs = decoder(
+                    input_ids=prefix_ids,
+                    attention_mask=prefix_mask,
+                    position_ids=(prefix_mask.cumsum(dim=1) - 1).clamp(min=0),
+                    use_cache=True,
+                )
+                past_key_values = fork_cache(prefix_outputs.past_key_values, 2)
+                offsets = prefix_mask.sum(dim=1).repeat_interleave(2)
+                outputs = decoder(
+                    input_ids=suffix_ids,
+                    attention_mask=torch.cat([prefix_mask.repeat_interleave(2, dim=0), suffix_mask], dim=1),
+                    position_ids=offsets[:, None] + torch.arange(suffix_len, device=device)[None, :],
+                    past_key_values=past_key_values,
+                    # with use_cache=False, transformers 4.40 does not convert a legacy (tuple) cache
+                    use_cache=True,
+                )
+                pooled = torch.tensor(pooled, device=device)
+                rows = self._head(gather_token_states(outputs.last_hidden_state, pooled))
+            # (2B, ...) -> (B, 2, ...) with chosen and rejected of a pair side by side
+            return rows.view(len(pairs), 2, *rows.shape[1:])
+
+        scores_chosen, scores_rejected = [], []
+        if shared:
+            lengths = [max(len(ids_chosen[i]), len(ids_rejected[i])) for i in shared]
+            rows = self.batcher(forward, lengths, batch_size)
+            scores_chosen.append(rows[:, 0])
+            scores_rejected.append(rows[:, 1])
+        if unshared:
+            encodings = {
+                k: [encodings_chosen[k][i] for i in unshared] + [encodings_rejected[k][i] for i in unshared]
+                for k in ("input_ids", "attention_mask")
+            }
+            rows = self.score(encodings, batch_size=batch_size, padding=kwargs.get("padding", True))
+            scores_chosen.append(rows[: len(unshared)])
+            scores_rejected.append(rows[len(unshared) :])
+
+        # restore the input order of the pairs
+        order = torch.tensor(shared + unshared, dtype=torch.long).argsort()
+        scores_chosen = torch.cat(scores_chosen, dim=0)
+        scores_rejected = torch.cat(scores_rejected, dim=0)
+        return scores_chosen[order.to(scores_chosen.device)], scores_rejected[order.to(scores_rejected.device)]
+
+
+class SequenceClassifierPipeline(RewardPipeline):
+    """
+    Scores texts directly with an `AutoModelForSequenceClassification` model, as a faster replacement of the
+    transformers text-classification pipeline with `function_to_apply="none"`: the score of a text is its largest
+    logit (the only logit of single-label reward models), returned as one float tensor instead of a dict per row.
+    """
+
+    def _forward(self, inputs):
+        return self.model(**inputs).logits.float().max(dim=-1).values
+
+    def _decoder(self):
+        # decoder-only classifiers (Llama, Mistral, ...) put a `score` head on top of the base model
+        if self.model.config.is_encoder_decoder or not hasattr(self.model, "score"):
+            return None
+        return self.model.base_model
+
+    def _head(self, hidden_states):
+        return self.model.score(hidden_states).float().max(dim=-1).values
+
+    def _pool_index(self, input_ids):
+        # transformers pools sequence classifiers at the token before the first pad token, or the last token if
+        # there is none; with pad = eos (see run_rm.py) that is the token before the first eos, not the last token
+        pad_id = self.model.config.pad_token_id
+        if pad_id is None or pad_id not in input_ids:
+            return len(input_ids) - 1
+        # a pad token at position 0 wraps around to the last position, as in transformers
+        return (input_ids.index(pad_id) - 1) % len(input_ids)
@@ -40,6 +40,9 @@ from transformers.utils.doc import (
 )
 from transformers.utils.generic import ModelOutput
 
+from .base import RewardPipeline
+from .utils import gather_token_states, last_token_index
+
 NormalizeFunction = Literal["affine", "scale", "translate", "identity"]
 NormalizerType = Literal["RunningMeanStd", "ExponentialMovingAverage"]
 
@@ -166,7 +169,7 @@ class ScoreModelOutput(ModelOutput):
 
     Args:
         scores (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, score_dim)`):
-            Prediction scores of the score model.
+            Prediction scores of the score model (None unless `score_all_positions` is set).
         end_scores (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, score_dim)`):
             Prediction scores of the end of the sequence.
         last_hidden_state (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_dim)`):
@@ -245,6 +248,8 @@ class ScoreModelMixin:
     score_head: nn.Linear
     normalizer: Normalizer
     do_normalize: bool = False
+    # per position scores are not needed to compare sequences, only compute them when set
+    score_all_positions: bool = False
     normalize_function: NormalizeFunction = "affine"
     _is_score_head_initialized: bool = False
 
@@ -315,26 +320,13 @@ class ScoreModelMixin:
                 raise ValueError("'attention_mask' is required when batch size > 1.")
             attention_mask = last_hidden_state.new_ones(B, L, dtype=torch.bool)  # size = (B, L)
 
-        scores = self.score_head(last_hidden_state).float()  # size = (B, L, D)
-
-        end_index = torch.cat([m.nonzero()[-1] for m in attention_mask])  # size = (B,)
-        end_last_hidden_state = torch.gather(  # size = (B, 1, E)
-            last_hidden_state,
-            dim=1,
-            index=(
-                end_index.to(last_hidden_state.device)
-                .unsqueeze(dim=1)
-                .unsqueeze(dim=2)
-                .expand(-1, -1, last_hidden_state.size(-1))
-            ),
-        )
-        end_scores = torch.gather(  # size = (B, 1, D)
-            scores,
-            dim=1,
-            index=(end_index.to(scores.device).unsqueeze(dim=1).unsqueeze(dim=2).expand(-1, -1, scores.size(-1))),
-        )
-        end_last_hidden_state = end_last_hidden_state.squeeze(dim=1)  # size = (B, E)
-        end_scores = end_scores.squeeze(dim=1)  # size = (B, D)
+        # only the end of every sequence is scored unless all positions are requested
+        end_index = last_token_index(attention_mask)  # size = (B,)
+        end_last_hidden_state = gather_token_states(last_hidden_state, end_index)  # size = (B, E)
+        end_scores = self.score_head(end_last_hidden_state).float()  # size = (B, D)
+        scores = None
+        if self.score_all_positions:
+            scores = self.score_head(last_hidden_state).float()  # size = (B, L, D)
 
         if self.training:
             if dist.is_initialized():
@@ -348,7 +340,8 @@ class ScoreModelMixin:
             self.config.var = self.normalizer.var.tolist()
 
         if self.do_normalize:
-            scores = self.normalizer.normalize(scores)
+            if scores is not None:
+                scores = self.normalizer.normalize(scores)
             end_scores = self.normalizer.normalize(end_scores)
 
         if not return_dict:
@@ -455,50 +448,24 @@ class LlamaForScore(ScoreModelMixin, LlamaPreTrainedModel):
 
 
 # Pipeline addition
-class BeaverPipeline:
-    # init loads task, tokenizer and model
-    def __init__(self, task, model, tokenizer):
-        self.task = task
-        self.model = model
-        self.tokenizer = tokenizer
-
-    def __call__(self, samples, **kwargs):
-        _ = kwargs.get("batch_size", 1)
-        truncation = kwargs.get("truncation", True)
-        padding = kwargs.get("padding", True)
-        max_length = kwargs.get("max_length", 2048)
-        inputs = self.tokenizer(
-            samples,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            return_tensors="pt",
-        ).to("cuda")
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        return outputs.end_scores
+class BeaverPipeline(RewardPipeline):
+    def _forward(self, inputs):
+        return self.model(**inputs).end_scores
+
+    def _decoder(self):
+        return self.model.model
+
+    def _head(self, hidden_states):
+        end_scores = self.model.score_head(hidden_states).float()
+        if self.model.do_normalize:
+            end_scores = self.model.normalizer.normalize(end_scores)
+        return end_scores
 
 
 # Pipeline addition
-class BeaverCostPipeline:
-    # init loads task, tokenizer and model
-    def __init__(self, task, model, tokenizer):
-        self.task = task
-        self.model = model
-        self.tokenizer = tokenizer
-
-    def __call__(self, samples, **kwargs):
-        _ = kwargs.get("batch_size", 1)
-        truncation = kwargs.get("truncation", True)
-        padding = kwargs.get("padding", True)
-        max_length = kwargs.get("max_length", 2048)
-        inputs = self.tokenizer(
-            samples,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            return_tensors="pt",
-        ).to("cuda")
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        return -outputs.end_scores
+class BeaverCostPipeline(BeaverPipeline):
+    def _forward(self, inputs):
+        return -super()._forward(inputs)
+
+    def _head(self, hidden_states):
+        return -super()._head(hidden_states)
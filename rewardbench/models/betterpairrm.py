@@ -21,17 +21,17 @@ from typing import List
 import jinja2
 from transformers import PreTrainedModel, PreTrainedTokenizer
 
-# tokenizer = AutoTokenizer.from_pretrained("microsoft/deberta-v3-large")
-
+from .pairrm import (
+    assemble_pair_ids,
+    encode_texts,
+    forward_length_bucketed,
+    truncate_ids,
+)
 
-def tokenize_conv_pair(tokenizer, convAs: List[str], convBs: List[str], **kwargs):
-    def truncate_texts(text, max_length, truncate_side):
-        tokenizer.truncation_side = truncate_side
-        tokens = tokenizer.encode(text, add_special_tokens=False, max_length=max_length)
-        truncated_text = tokenizer.decode(tokens, skip_special_tokens=True)
-        return truncated_text
+# tokenizer = AutoTokenizer.from_pretrained("microsoft/deberta-v3-large")
 
-    BETTER_PAIRRM_TEMPLATE = """{% for message in messages -%}
+# the continuation lines keep their leading indentation, it is part of the rendered template
+BETTER_PAIRRM_TEMPLATE = """{% for message in messages -%}
     {% if message['role'] == 'user' -%}
     USER: {{ message['content']|trim -}}
     {% if not loop.last -%}
@@ -61,9 +61,11 @@ def tokenize_conv_pair(tokenizer, convAs: List[str], convBs: List[str], **kwargs
     {% if add_generation_prompt and messages[-1]['role'] != 'assistant' -%}
     ASSISTANT: {% endif -%}"""
 
-    jinja2_env = jinja2.Environment()
-    jinja2_template = jinja2_env.from_string(BETTER_PAIRRM_TEMPLATE)
+# compile once at import, rendering a compiled template is thread safe
+BETTER_PAIRRM_JINJA_TEMPLATE = jinja2.Environment().from_string(BETTER_PAIRRM_TEMPLATE)
+
 
+def tokenize_conv_pair(tokenizer, convAs: List[str], convBs: List[str], **kwargs):
     assert len(convAs) == len(convBs), "Number of conversations must be the same"
     for c_a, c_b in zip(convAs, convBs):
         assert len(c_a) == len(c_b), "Number of turns in each conversation must be the same"
@@ -71,14 +73,17 @@ def tokenize_conv_pair(tokenizer, convAs: List[str], convBs: List[str], **kwargs
             [c_a[i]["content"] == c_b[i]["content"] for i in range(0, len(c_a), 2)]
         ), "USER turns must be the same"
 
-    inputs = [
-        truncate_texts(jinja2_template.render(messages=x[:-1], add_generation_prompt=True), 2030, "left")
-        for x in convAs
-    ]
-    cand1_texts = [truncate_texts(x[-1]["content"], 670, "right") for x in convAs]
-    cand2_texts = [truncate_texts(x[-1]["content"], 670, "right") for x in convBs]
-
-    encodings = tokenize_pair(tokenizer, inputs, cand1_texts, cand2_texts, **kwargs)
+    # encode each text once and truncate at the token level (no decode / re-encode round trip),
+    # the source keeps its end and the candidates their beginning
+    source_ids = encode_texts(
+        tokenizer,
+        [BETTER_PAIRRM_JINJA_TEMPLATE.render(messages=x[:-1], add_generation_prompt=True) for x in convAs],
+    )
+    source_ids = [ids[-2030:] for ids in source_ids]
+    candidate1_ids = [ids[:670] for ids in encode_texts(tokenizer, [x[-1]["content"] for x in convAs])]
+    candidate2_ids = [ids[:670] for ids in encode_texts(tokenizer, [x[-1]["content"] for x in convBs])]
+
+    encodings = tokenize_pair_ids(tokenizer, source_ids, candidate1_ids, candidate2_ids, **kwargs)
     return encodings
 
 
@@ -87,6 +92,23 @@ def tokenize_pair(
     sources: List[str],
     candidate1s: List[str],
     candidate2s: List[str],
+    **kwargs,
+):
+    assert len(sources) == len(candidate1s) == len(candidate2s)
+    return tokenize_pair_ids(
+        tokenizer,
+        encode_texts(tokenizer, sources),
+        encode_texts(tokenizer, candidate1s),
+        encode_texts(tokenizer, candidate2s),
+        **kwargs,
+    )
+
+
+def tokenize_pair_ids(
+    tokenizer,
+    source_ids: List[List[int]],
+    candidate1_ids: List[List[int]],
+    candidate2_ids: List[List[int]],
     source_prefix="<|source|>",
     cand1_prefix="<|candidate1|>",
     cand2_prefix="<|candidate2|>",
@@ -94,27 +116,26 @@ def tokenize_pair(
     candidate_max_length=670,
     **kwargs,
 ):
-    ids = []
-    assert len(sources) == len(candidate1s) == len(candidate2s)
+    """
+    Same as `tokenize_pair` for texts that are already encoded (without special tokens).
+    Does not modify the tokenizer, so it is safe to call from parallel workers.
+    """
+    assert len(source_ids) == len(candidate1_ids) == len(candidate2_ids)
     source_tokens = tokenizer.encode(source_prefix)
+    cand1_tokens = tokenizer.encode(cand1_prefix, add_special_tokens=False)
+    cand2_tokens = tokenizer.encode(cand2_prefix, add_special_tokens=False)
     max_length = source_max_length + 2 * candidate_max_length
-    for i in range(len(sources)):
-        tokenizer.truncation_side = "left"
-        source_ids = source_tokens + tokenizer.encode(
-            sources[i], max_length=source_max_length - len(source_tokens), truncation=True
-        )
-
-        tokenizer.truncation_side = "right"
-        candidate_max_length = (max_length - len(source_ids)) // 2
-        candidate1_ids = tokenizer.encode(
-            cand1_prefix + candidate1s[i], max_length=candidate_max_length, truncation=True
-        )
-        candidate2_ids = tokenizer.encode(
-            cand2_prefix + candidate2s[i], max_length=candidate_max_length, truncation=True
-        )
-        ids.append(source_ids + candidate1_ids + candidate2_ids)
+    # sources keep their end (left truncation), candidates their beginning (right truncation)
+    source_ids = [
+        source_tokens + truncate_ids(tokenizer, ids, source_max_length - len(source_tokens), truncation_side="left")
+        for ids in source_ids
+    ]
+    candidate1_ids = [cand1_tokens + ids for ids in candidate1_ids]
+    candidate2_ids = [cand2_tokens + ids for ids in candidate2_ids]
+    ids = assemble_pair_ids(tokenizer, source_ids, candidate1_ids, candidate2_ids, max_length)
 
-    encodings = tokenizer.pad({"input_ids": ids}, return_tensors="pt", padding="max_length", max_length=max_length)
+    # pad to the longest row of the batch rather than the maximum length
+    encodings = tokenizer.pad({"input_ids": ids}, return_tensors="pt", padding="longest")
     return encodings
 
 
@@ -128,14 +149,23 @@ class BetterPairRMPipeline:
         self.tokenizer = tokenizer
         # turn off gradients for model and set in eval mode
         self.model.eval().requires_grad_(False)
+        # tokenize_pair always keeps the prefix ids, skip validating them in the forward pass
+        self.model.validate_inputs = False
 
     def __call__(self, candidates_A: List[str], candidates_B: List[str], output_logits=False, **kwargs):
-        AB_encodings = tokenize_conv_pair(self.tokenizer, candidates_A, candidates_B, **kwargs)
-        AB_outputs = self.model(**AB_encodings.to(self.model.device))
-        AB_logits = AB_outputs.logits
-        BA_encodings = tokenize_conv_pair(self.tokenizer, candidates_B, candidates_A, **kwargs)
-        BA_outputs = self.model(**BA_encodings.to(self.model.device))
-        BA_logits = BA_outputs.logits
+        # score the (A, B) and (B, A) orderings together, the sources are identical for both orderings
+        # so they are only tokenized once. batch_size counts pairs, i.e. both orderings share a forward pass
+        num_pairs = len(candidates_A)
+        batch_size = kwargs.get("batch_size", num_pairs)
+        encodings = tokenize_conv_pair(
+            self.tokenizer,
+            list(candidates_A) + list(candidates_B),
+            list(candidates_B) + list(candidates_A),
+            **kwargs,
+        )
+        all_logits = forward_length_bucketed(self.model, encodings, batch_size=2 * batch_size)
+        AB_logits = all_logits[:num_pairs]
+        BA_logits = all_logits[num_pairs:]
         logits = AB_logits - BA_logits
         if output_logits:
             return logits.tolist()
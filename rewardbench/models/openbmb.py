@@ -18,28 +18,19 @@ import torch
 import torch.nn as nn
 from transformers import LlamaConfig, LlamaModel, PreTrainedModel
 
+from .base import RewardPipeline
+from .utils import gather_token_states, last_token_index
 
-class OpenBMBPipeline:
-    def __init__(self, task, model, tokenizer):
-        self.task = task
-        self.model = model
-        self.tokenizer = tokenizer
 
-    def __call__(self, samples, **kwargs):
-        _ = kwargs.get("batch_size", 1)
-        truncation = kwargs.get("truncation", True)
-        padding = kwargs.get("padding", True)
-        max_length = kwargs.get("max_length", 2048)
-        inputs = self.tokenizer(
-            samples,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            return_tensors="pt",
-        ).to("cuda")
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        return outputs
+class OpenBMBPipeline(RewardPipeline):
+    def _forward(self, inputs):
+        return self.model(**inputs)
+
+    def _decoder(self):
+        return self.model.model
+
+    def _head(self, hidden_states):
+        return self.model.regression_head(hidden_states)
 
 
 class LlamaRewardModel(PreTrainedModel):
@@ -72,9 +63,9 @@ class LlamaRewardModel(PreTrainedModel):
         )
 
         hidden_states = transformer_outputs[0]
-        rewards = self.regression_head(hidden_states).squeeze(-1)
 
-        ends = attention_mask.cumsum(dim=1).argmax(dim=1).view(-1, 1)
-        rewards = torch.gather(rewards, 1, ends)
+        # only apply the head at the last token of every sequence
+        ends = last_token_index(attention_mask)
+        rewards = self.regression_head(gather_token_states(hidden_states, ends))
 
         return rewards
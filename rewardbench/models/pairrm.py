@@ -81,6 +81,62 @@ def tokenize_conv_pair(tokenizer, convAs: List[str], convBs: List[str], **kwargs
     return encodings
 
 
+def encode_texts(tokenizer, texts: List[str]) -> List[List[int]]:
+    """
+    Encode texts without special tokens in a single batched tokenizer call, encoding every distinct text once.
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    if len(unique_texts) == 0:
+        return []
+    encoded = tokenizer(unique_texts, add_special_tokens=False)["input_ids"]
+    lookup = dict(zip(unique_texts, encoded))
+    return [lookup[text] for text in texts]
+
+
+def truncate_ids(tokenizer, ids: List[int], max_length: int, truncation_side: str = "right") -> List[int]:
+    """
+    Truncate token ids and add special tokens, equivalent to `tokenizer.encode(text, max_length, truncation=True)`
+    on the text of `ids`, without touching the (shared) `tokenizer.truncation_side` attribute.
+
+    The special tokens are added with `tokenizer.build_inputs_with_special_tokens`, so the tokenizer has to implement
+    it, as the DeBERTa tokenizers of the PairRM models do. Generic fast tokenizers only add them in their backend
+    post-processor and are rejected.
+    """
+    num_special_tokens = tokenizer.num_special_tokens_to_add()
+    budget = max(max_length - num_special_tokens, 0)
+    if len(ids) > budget:
+        ids = ids[:budget] if truncation_side == "right" else ids[len(ids) - budget :]
+    output = tokenizer.build_inputs_with_special_tokens(ids)
+    if len(output) != len(ids) + num_special_tokens:
+        raise ValueError(
+            f"{type(tokenizer).__name__} does not add its {num_special_tokens} special tokens in "
+            "build_inputs_with_special_tokens, use a tokenizer that does (e.g. DebertaV2TokenizerFast)"
+        )
+    return output
+
+
+def assemble_pair_ids(
+    tokenizer,
+    source_ids: List[List[int]],
+    candidate1_ids: List[List[int]],
+    candidate2_ids: List[List[int]],
+    max_length: int,
+) -> List[List[int]]:
+    """
+    Concatenate final source ids with the (prefixed, untruncated) candidate ids, splitting the remaining length
+    budget of every row evenly between the two candidates.
+    """
+    ids = []
+    for source, cand1, cand2 in zip(source_ids, candidate1_ids, candidate2_ids):
+        candidate_max_length = (max_length - len(source)) // 2
+        ids.append(
+            source
+            + truncate_ids(tokenizer, cand1, candidate_max_length)
+            + truncate_ids(tokenizer, cand2, candidate_max_length)
+        )
+    return ids
+
+
 def tokenize_pair(
     tokenizer,
     sources: List[str],
@@ -93,23 +149,38 @@ def tokenize_pair(
     candidate_max_length=412,
     **kwargs,
 ):
-    ids = []
     assert len(sources) == len(candidate1s) == len(candidate2s)
     max_length = source_max_length + 2 * candidate_max_length
-    for i in range(len(sources)):
-        source_ids = tokenizer.encode(source_prefix + sources[i], max_length=source_max_length, truncation=True)
-        candidate_max_length = (max_length - len(source_ids)) // 2
-        candidate1_ids = tokenizer.encode(
-            cand1_prefix + candidate1s[i], max_length=candidate_max_length, truncation=True
-        )
-        candidate2_ids = tokenizer.encode(
-            cand2_prefix + candidate2s[i], max_length=candidate_max_length, truncation=True
-        )
-        ids.append(source_ids + candidate1_ids + candidate2_ids)
-    encodings = tokenizer.pad({"input_ids": ids}, return_tensors="pt", padding="max_length", max_length=max_length)
+    # the same source is often paired with many candidates (e.g. BoN tournaments), encode_texts encodes it once
+    source_ids = [
+        truncate_ids(tokenizer, ids, source_max_length)
+        for ids in encode_texts(tokenizer, [source_prefix + s for s in sources])
+    ]
+    candidate1_ids = encode_texts(tokenizer, [cand1_prefix + c for c in candidate1s])
+    candidate2_ids = encode_texts(tokenizer, [cand2_prefix + c for c in candidate2s])
+    ids = assemble_pair_ids(tokenizer, source_ids, candidate1_ids, candidate2_ids, max_length)
+    # pad to the longest row of the batch rather than the maximum length
+    encodings = tokenizer.pad({"input_ids": ids}, return_tensors="pt", padding="longest")
     return encodings
 
 
+def forward_length_bucketed(model, encodings, batch_size: int = None) -> torch.Tensor:
+    """
+    Run a pairwise model on (right padded) encodings in micro-batches of rows with similar lengths,
+    where each micro-batch is only padded to its own longest row. Logits are returned in input order.
+    """
+    lengths = encodings["attention_mask"].sum(dim=1)
+    batch_size = batch_size if batch_size else len(lengths)
+    order = torch.argsort(lengths, descending=True)
+    logits = []
+    for start in range(0, len(order), batch_size):
+        rows = order[start : start + batch_size]
+        width = int(lengths[rows].max())
+        inputs = {k: v[rows, :width].to(model.device) for k, v in encodings.items()}
+        logits.append(model(**inputs).logits)
+    return torch.cat(logits)[torch.argsort(order).to(logits[0].device)]
+
+
 class PairRMPipeline:
     """
     This class outputs a delta rather than a score for each.
@@ -120,14 +191,23 @@ class PairRMPipeline:
         self.tokenizer = tokenizer
         # turn off gradients for model and set in eval mode
         self.model.eval().requires_grad_(False)
+        # tokenize_pair always keeps the prefix ids, skip validating them in the forward pass
+        self.model.validate_inputs = False
 
     def __call__(self, candidates_A: List[str], candidates_B: List[str], output_logits=False, **kwargs):
-        AB_encodings = tokenize_conv_pair(self.tokenizer, candidates_A, candidates_B, **kwargs)
-        AB_outputs = self.model(**AB_encodings.to(self.model.device))
-        AB_logits = AB_outputs.logits
-        BA_encodings = tokenize_conv_pair(self.tokenizer, candidates_B, candidates_A, **kwargs)
-        BA_outputs = self.model(**BA_encodings.to(self.model.device))
-        BA_logits = BA_outputs.logits
+        # score the (A, B) and (B, A) orderings together, the sources are identical for both orderings
+        # so they are only tokenized once. batch_size counts pairs, i.e. both orderings share a forward pass
+        num_pairs = len(candidates_A)
+        batch_size = kwargs.get("batch_size", num_pairs)
+        encodings = tokenize_conv_pair(
+            self.tokenizer,
+            list(candidates_A) + list(candidates_B),
+            list(candidates_B) + list(candidates_A),
+            **kwargs,
+        )
+        all_logits = forward_length_bucketed(self.model, encodings, batch_size=2 * batch_size)
+        AB_logits = all_logits[:num_pairs]
+        BA_logits = all_logits[num_pairs:]
         logits = AB_logits - BA_logits
         if output_logits:
             return logits.tolist()
@@ -151,6 +231,8 @@ class DebertaV2PairRM(DebertaV2PreTrainedModel):
         self.cand_prefix_id = config.cand_prefix_id
         self.cand1_prefix_id = config.cand1_prefix_id
         self.cand2_prefix_id = config.cand2_prefix_id
+        # check that every row contains the prefix ids, can be turned off when inputs come from tokenize_pair
+        self.validate_inputs = True
 
         self.head_layer = nn.Sequential(
             nn.Dropout(self.drop_out),
@@ -180,39 +262,36 @@ class DebertaV2PairRM(DebertaV2PreTrainedModel):
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for computing the token classification loss. Indices should be in `[0, ..., config.num_labels - 1]`.
         """
-        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
         #  <source_prefix_id>...<sep><cand1_prefix_id>...<sep><cand2_prefix_id> ... <sep>
-        assert all(
-            [self.source_prefix_id in input_ids[i] for i in range(input_ids.shape[0])]
-        ), "<source> id not in input_ids"
-        assert all(
-            [self.cand1_prefix_id in input_ids[i] for i in range(input_ids.shape[0])]
-        ), "<candidate1> id not in input_ids"
-        assert all(
-            [self.cand2_prefix_id in input_ids[i] for i in range(input_ids.shape[0])]
-        ), "<candidate2> id not in input_ids"
+        prefix_ids = (self.source_prefix_id, self.cand1_prefix_id, self.cand2_prefix_id)
+        if self.validate_inputs:
+            # vectorized check over the batch, a single device sync instead of one per row
+            present = torch.stack([(input_ids == prefix_id).any(dim=-1) for prefix_id in prefix_ids]).all(dim=-1)
+            if not present.all():
+                missing = [name for name, ok in zip(("<source>", "<candidate1>", "<candidate2>"), present) if not ok]
+                raise ValueError(f"{', '.join(missing)} id not in input_ids")
 
         keep_column_mask = attention_mask.ne(0).any(dim=0)
         input_ids = input_ids[:, keep_column_mask]
         attention_mask = attention_mask[:, keep_column_mask]
+        # only the last layer is needed, don't keep every layer's activations alive unless asked for
         outputs = self.pretrained_model(
             input_ids=input_ids,
             attention_mask=attention_mask,
-            output_hidden_states=True,
-            return_dict=return_dict,
+            output_hidden_states=output_hidden_states,
+            return_dict=True,
             token_type_ids=token_type_ids,
             position_ids=position_ids,
             inputs_embeds=inputs_embeds,
             output_attentions=output_attentions,
         )
-        encs = outputs.hidden_states[-1]
-        source_idxs = torch.where(input_ids == self.source_prefix_id)
-        source_encs = encs[source_idxs[0], source_idxs[1], :]
-        cand1_idxs = torch.where(input_ids == self.cand1_prefix_id)
-        cand1_encs = encs[cand1_idxs[0], cand1_idxs[1], :]
-        cand2_idxs = torch.where(input_ids == self.cand2_prefix_id)
-        cand2_encs = encs[cand2_idxs[0], cand2_idxs[1], :]
+        encs = outputs.last_hidden_state
+
+        # position of the first occurrence of each prefix id in every row
+        batch_idxs = torch.arange(input_ids.shape[0], device=input_ids.device)
+        source_encs, cand1_encs, cand2_encs = [
+            encs[batch_idxs, (input_ids == prefix_id).int().argmax(dim=-1), :] for prefix_id in prefix_ids
+        ]
 
         # reduce
         source_cand1_encs = torch.cat([source_encs, cand1_encs], dim=-1)
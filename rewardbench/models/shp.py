@@ -13,22 +13,30 @@
 # limitations under the License.
 # Instructions from readme here https://huggingface.co/stanfordnlp/SteamSHP-flan-t5-xl
 
-import random
-from typing import Dict, List
+from typing import Dict, List, Mapping, Optional, Union
 
 import torch
 from transformers import PreTrainedModel, PreTrainedTokenizer
 
+from .base import RewardPipeline
 
-class SHPPipeline:
+
+class SHPPipeline(RewardPipeline):
     def __init__(self, task, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
-        self.task = task
-        self.model = model
-        self.tokenizer = tokenizer
+        super().__init__(task, model, tokenizer)
         # turn off gradients for model and set in eval mode
         self.model.eval().requires_grad_(False)
-
-    def __call__(self, candidates_A: List[List[Dict]], candidates_B: List[List[Dict]], **kwargs):
+        # the model answers with a single token, "A" or "B"
+        self.token_id_A = self.tokenizer("A", add_special_tokens=False)["input_ids"][-1]
+        self.token_id_B = self.tokenizer("B", add_special_tokens=False)["input_ids"][-1]
+
+    def __call__(
+        self,
+        candidates_A: Union[List[List[Dict]], Mapping],
+        candidates_B: Optional[List[List[Dict]]] = None,
+        output_logits=False,
+        **kwargs,
+    ):
         """
         Inputs should be the following format, where candidates_A/B are lists of lists of dicts with strings (batches):
         [
@@ -55,8 +63,8 @@ class SHPPipeline:
 
         ---
         The way to do this is get the post as the part of response a and response b that are the same.
-        Then randomize the order of response a and response b, and then tokenize the entire sequence.
-        Pass it into the model, decide on winner.
+        Then format both orders of response a and response b, and then tokenize the entire sequences.
+        Pass them into the model, decide on winner.
 
         From the model readme:
         >> input_text = "POST: Instacart gave me 50 pounds of limes instead of 5 pounds...
@@ -68,41 +76,55 @@ class SHPPipeline:
         >> tokenizer.batch_decode(y, skip_special_tokens=True)
         >> ['A'] # returns A or B
 
-        Output will be a list of True or False if response A was chosen by the model over B
+        Rather than generating the answer token, both orderings (A, B) and (B, A) are scored with a single
+        decoder step (teacher forcing the decoder start token) and the logits of the "A" and "B" tokens are compared.
+
+        Output will be a boolean tensor that is True if response A was preferred by the model over B,
+        or, with `output_logits=True`, the list of real-valued margins (positive if A is preferred).
+
+        Instead of the two batches of conversations, `candidates_A` can be the pre-tokenized output of `preprocess`.
+        """
+        if isinstance(candidates_A, Mapping):
+            encodings = self.to_encodings(candidates_A)
+        else:
+            encodings = self.preprocess(candidates_A, candidates_B, **kwargs)
+
+        batch_size = kwargs.get("batch_size", len(encodings["input_ids"]) // 2)  # counted in pairs
+        scores = self.score(encodings, batch_size=2 * batch_size, padding=kwargs.get("padding", True))
+
+        # preference for the first response of the pair, averaged over both positions
+        margins = (scores[0::2] - scores[1::2]) / 2
+        if output_logits:
+            return margins.tolist()
+        else:
+            return margins > 0
+
+    def preprocess(self, candidates_A: List[List[Dict]], candidates_B: List[List[Dict]], **kwargs):
+        """
+        Format and tokenize both orderings of every pair, interleaved as [A B, B A, A B, B A, ...].
         """
         assert len(candidates_A) == len(candidates_B), "Batches of candidates A and B must have the same length"
 
+        # interleave both orderings of every pair, [A B, B A, A B, B A, ...]
         input_texts = []
-        orders = []
         for conv_A, conv_B in zip(candidates_A, candidates_B):
             conversation = self._extract_conversation(conv_A, conv_B)
             response_A = conv_A[-1]["content"]  # Last message of A
             response_B = conv_B[-1]["content"]  # Last message of B
-            formatted_input, order = self._format_input(conversation, response_A, response_B)
-            input_texts.append(formatted_input)
-            orders.append(order)
-
-        _ = kwargs.get("batch_size", 1)
-        truncation = kwargs.get("truncation", True)
-        padding = kwargs.get("padding", True)
-        max_length = kwargs.get("max_length", 2048)
-
-        tokenized_inputs = self.tokenizer(
-            input_texts,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            return_tensors="pt",
-        ).to("cuda")
-        outputs = self.model.generate(**tokenized_inputs, max_new_tokens=1)
-        decoded_outputs = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-
-        bools = [output == "A" for output in decoded_outputs]
-        # for each order in orders, if order is BA, flip the bool in bools
-        for i, order in enumerate(orders):
-            if order == "BA":
-                bools[i] = not bools[i]
-        return torch.Tensor(bools)
+            input_texts.append(self._format_input(conversation, response_A, response_B))
+            input_texts.append(self._format_input(conversation, response_B, response_A))
+
+        return super().preprocess(input_texts, **kwargs)
+
+    def _forward(self, inputs):
+        decoder_input_ids = torch.full(
+            (inputs["input_ids"].shape[0], 1),
+            self.model.config.decoder_start_token_id,
+            dtype=torch.long,
+            device=inputs["input_ids"].device,
+        )
+        logits = self.model(**inputs, decoder_input_ids=decoder_input_ids).logits[:, 0, :]
+        return (logits[:, self.token_id_A] - logits[:, self.token_id_B]).float()
 
     def _extract_conversation(self, conv_A: List[Dict], conv_B: List[Dict]) -> str:
         # Combine the messages in the conversation, excluding the last responses
@@ -110,13 +132,6 @@ class SHPPipeline:
         return " ".join(conversation)
 
     def _format_input(self, post: str, response_A: str, response_B: str) -> str:
-        # Randomize the order of responses, but keep labels (A, B) fixed
-        responses = [(response_A, "A"), (response_B, "B")]
-        random.shuffle(responses)
-
-        # Keep track of the order
-        order = "".join([label for _, label in responses])
-
-        # Use fixed labels with potentially swapped response contents
-        formatted_responses = f"\n\n RESPONSE A: {responses[0][0]}\n\n RESPONSE B: {responses[1][0]}"
-        return f"POST: {post}{formatted_responses}\n\n Which response is better? RESPONSE", order
+        # position bias is handled by scoring both orders, so the responses are kept in the given order
+        formatted_responses = f"\n\n RESPONSE A: {response_A}\n\n RESPONSE B: {response_B}"
+        return f"POST: {post}{formatted_responses}\n\n Which response is better? RESPONSE"
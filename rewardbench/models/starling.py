@@ -15,7 +15,6 @@
 # Copied partially from https://huggingface.co/berkeley-nest/Starling-RM-7B-alpha#uses
 # with modifications & fixes
 
-import math
 import os
 
 import torch
@@ -28,6 +27,9 @@ from transformers import (
     LlamaPreTrainedModel,
 )
 
+from .base import RewardPipeline
+from .utils import gather_token_states, token_before_first_pad_index
+
 SUPPORTED_STARLING_MODELS = ["berkeley-nest/Starling-RM-7B-alpha", "Nexusflow/Starling-RM-34B"]
 
 
@@ -77,17 +79,11 @@ class LlamaForSequenceClassification(LlamaPreTrainedModel):
             input_ids,
             attention_mask=attention_mask,
             position_ids=position_ids,
-            output_hidden_states=True,
         )
-        hidden_states = transformer_outputs.hidden_states[-1]
-        scores = []
-        rewards = self.v_head(hidden_states).squeeze(-1)
-        bs = int(input_ids.shape[0])
-        for i in range(bs):
-            c_inds = (input_ids[i] == self.PAD_ID).nonzero()
-            c_ind = c_inds[0].item() if len(c_inds) > 0 else input_ids.shape[1]
-            scores.append(rewards[i, c_ind - 1])
-        scores = torch.stack(scores)
+        hidden_states = transformer_outputs[0]
+        # only apply the head at the token before the first pad token of every sequence
+        ends = token_before_first_pad_index(input_ids, self.PAD_ID)
+        scores = self.v_head(gather_token_states(hidden_states, ends)).squeeze(-1)
         return {"scores": scores}
 
 
@@ -116,9 +112,8 @@ class GPTRewardModel(nn.Module):
     ):
         """
         input_ids, attention_mask: torch.Size([bs, seq_len])
-        return: scores: List[bs]
+        return: scores: torch.Size([bs])
         """
-        bs = input_ids.shape[0]
         transformer_outputs = self.transformer(
             input_ids,
             past_key_values=past_key_values,
@@ -126,48 +121,20 @@ class GPTRewardModel(nn.Module):
             position_ids=position_ids,
         )
         hidden_states = transformer_outputs[0]
-        scores = []
-        rewards = self.v_head(hidden_states).squeeze(-1)
-        for i in range(bs):
-            c_inds = (input_ids[i] == self.PAD_ID).nonzero()
-            c_ind = c_inds[0].item() if len(c_inds) > 0 else input_ids.shape[1]
-            scores.append(rewards[i, c_ind - 1])
+        # only apply the head at the token before the first pad token of every sequence
+        ends = token_before_first_pad_index(input_ids, self.PAD_ID)
+        scores = self.v_head(gather_token_states(hidden_states, ends)).squeeze(-1)
         return scores
 
 
-class StarlingPipeline:
-    def __init__(self, task, model, tokenizer):
-        self.task = task
-        self.model = model
-        self.tokenizer = tokenizer
+class StarlingPipeline(RewardPipeline):
+    @property
+    def device(self):
+        return self.model.get_device()
 
-    def __call__(self, samples, **kwargs):
-        """
-        samples: List[str]
-        """
-        batch_size = kwargs.get("batch_size", 1)
-        truncation = kwargs.get("truncation", True)
-        padding = kwargs.get("padding", True)
-        max_length = kwargs.get("max_length", 2048)
-        encoding_dict = self.tokenizer(
-            samples,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            return_tensors="pt",
-        ).to("cuda")
-        input_ids = encoding_dict["input_ids"]
-        attention_masks = encoding_dict["attention_mask"]
-        out = []
-        with torch.no_grad():
-            for i in range(math.ceil(len(samples) / batch_size)):
-                rewards = self.model(
-                    input_ids=input_ids[i * batch_size : (i + 1) * batch_size],
-                    attention_mask=attention_masks[i * batch_size : (i + 1) * batch_size],
-                )
-                # if scores are dict (for Yi model), extract them from tensor.
-                if isinstance(rewards, dict):
-                    rewards = rewards["scores"]
-                out.extend(rewards)
-
-        return torch.hstack(out)
+    def _forward(self, inputs):
+        rewards = self.model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+        # if scores are dict (for Yi model), extract them from tensor.
+        if isinstance(rewards, dict):
+            rewards = rewards["scores"]
+        return rewards
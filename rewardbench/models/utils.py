@@ -0,0 +1,100 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared helpers for the custom reward model code
+
+from typing import List
+
+import torch
+
+
+def last_token_index(attention_mask: torch.Tensor) -> torch.LongTensor:
+    """
+    Index of the last attended token of every row, for right or left padded batches.
+    The cumulative sum of the mask reaches its maximum at the last 1, argmax returns that first position.
+    """
+    return attention_mask.long().cumsum(dim=1).argmax(dim=1)
+
+
+def token_before_first_pad_index(input_ids: torch.Tensor, pad_id: int) -> torch.LongTensor:
+    """
+    Index of the token before the first `pad_id` of every row, or the last position if a row has no padding
+    (the convention of the Starling reward models).
+    """
+    is_pad = input_ids == pad_id
+    seq_len = input_ids.shape[1]
+    first_pad = torch.where(is_pad.any(dim=1), is_pad.int().argmax(dim=1), torch.full_like(input_ids[:, 0], seq_len))
+    # a pad token at position 0 wraps around to the last position, as negative indexing did
+    return (first_pad - 1) % seq_len
+
+
+def gather_token_states(hidden_states: torch.Tensor, index: torch.Tensor) -> torch.Tensor:
+    """
+    Select one hidden state per row, (B, L, E) and (B,) -> (B, E), so heads only run on those positions.
+    """
+    batch_idx = torch.arange(hidden_states.shape[0], device=hidden_states.device)
+    return hidden_states[batch_idx, index.to(hidden_states.device)]
+
+
+class AdaptiveBatcher:
+    """
+    Runs a forward function over micro-batches of at most `batch_size` samples, longest samples first.
+    When a micro-batch runs out of CUDA memory it is halved and retried, and the largest size that fits is
+    remembered per sequence length bucket for the rest of the run (and applied to longer buckets as well).
+    """
+
+    def __init__(self, bucket_width: int = 256):
+        self.bucket_width = bucket_width
+        self.max_batch_sizes = {}  # length bucket -> largest batch size known not to run out of memory
+
+    def batch_size_limit(self, length: int, batch_size: int) -> int:
+        bucket = length // self.bucket_width
+        limits = [size for b, size in self.max_batch_sizes.items() if b <= bucket]
+        return min([batch_size] + limits)
+
+    def __call__(self, forward_fn, lengths: List[int], batch_size: int) -> torch.Tensor:
+        """
+        Args:
+            forward_fn: callable taking a list of sample indices and returning a tensor with one row per index.
+            lengths: sequence length of every sample, used for sorting and bucketing.
+            batch_size: maximum number of samples per forward pass.
+
+        Returns:
+            The rows returned by `forward_fn` in input order, written into one preallocated tensor.
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        outputs = None
+        start = 0
+        while start < len(order):
+            # the first sample of a chunk is its longest
+            length = lengths[order[start]]
+            size = self.batch_size_limit(length, batch_size)
+            while True:
+                chunk = order[start : start + size]
+                try:
+                    rows = forward_fn(chunk)
+                    break
+                except torch.cuda.OutOfMemoryError:
+                    if size == 1:
+                        raise
+                    size = size // 2
+                    self.max_batch_sizes[length // self.bucket_width] = size
+                torch.cuda.empty_cache()
+            if outputs is None:
+                outputs = rows.new_empty((len(order),) + rows.shape[1:])
+            # scatter the rows of the chunk back to their input positions
+            outputs[torch.tensor(chunk, dtype=torch.long, device=rows.device)] = rows
+            start += size
+
+        return outputs
@@ -12,28 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import torch
+from .base import RewardPipeline
 
 
 # pipeline because custom model returns reward directly compared to other models
-class ZiyaPipeline:
+class ZiyaPipeline(RewardPipeline):
     def __init__(self, task, model, tokenizer):
-        self.task = task
-        self.model = model.eval().half().cuda()
-        self.tokenizer = tokenizer
+        super().__init__(task, model.eval().half().cuda(), tokenizer)
 
-    def __call__(self, query, **kwargs):
-        _ = kwargs.get("batch_size", 1)
-        truncation = kwargs.get("truncation", True)
-        padding = kwargs.get("padding", True)
-        max_length = kwargs.get("max_length", 2048)
-        inputs = self.tokenizer(
-            query,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            return_tensors="pt",
-        ).to("cuda")
-        with torch.no_grad():
-            reward = self.model(**inputs)
-        return reward
+    def _forward(self, inputs):
+        return self.model(**inputs)
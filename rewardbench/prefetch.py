@@ -0,0 +1,128 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Background prefetching of batches for the inference loops (run_rm.py, run_bon.py, run_dpo.py)
+
+import queue
+import threading
+from typing import Any, Iterable, Optional, Union
+
+import torch
+
+_END = object()
+
+
+def move_to_device(batch: Any, device: torch.device, pin_memory: bool = False) -> Any:
+    """
+    Recursively move the tensors of a (nested) batch to `device` with non-blocking copies, other values are kept.
+    With `pin_memory`, tensors are first copied to page-locked host memory so the transfer is asynchronous.
+    """
+    if isinstance(batch, torch.Tensor):
+        if pin_memory and batch.device.type == "cpu":
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return type(batch)({k: move_to_device(v, device, pin_memory) for k, v in batch.items()})
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(move_to_device(v, device, pin_memory) for v in batch)
+    return batch
+
+
+def _record_stream(batch: Any, stream: "torch.cuda.Stream"):
+    # tensors allocated on the copy stream are used on the compute stream, tell the caching allocator
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class BatchPrefetcher:
+    """
+    Wraps a DataLoader (or any iterable of batches) and prepares the next batches in a background thread while the
+    current one is computed: the thread runs collation (and the DataLoader workers, if any), pins the tensors and
+    starts their copy to `device` on a separate CUDA stream. Up to `num_prefetch` batches are kept in a bounded queue.
+
+    Batches are yielded in the order of the underlying iterable and are otherwise unchanged, so results do not
+    depend on prefetching. With `device=None` batches are only fetched ahead, e.g. for custom pipelines that
+    place their inputs themselves.
+    """
+
+    def __init__(
+        self,
+        dataloader: Iterable,
+        device: Optional[Union[str, torch.device]] = None,
+        num_prefetch: int = 2,
+    ):
+        self.dataloader = dataloader
+        self.device = torch.device(device) if device is not None else None
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        use_cuda = self.device is not None and self.device.type == "cuda"
+        copy_stream = torch.cuda.Stream(self.device) if use_cuda else None
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # give up if the consumer stopped iterating, so the thread does not block forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def producer():
+            try:
+                for batch in self.dataloader:
+                    event = None
+                    if copy_stream is not None:
+                        with torch.cuda.stream(copy_stream):
+                            batch = move_to_device(batch, self.device, pin_memory=True)
+                        event = torch.cuda.Event()
+                        event.record(copy_stream)
+                    elif self.device is not None:
+                        batch = move_to_device(batch, self.device)
+                    if not put((batch, event)):
+                        return
+                put((_END, None))
+            except BaseException as e:  # re-raised in the main thread
+                put((e, None))
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event = batches.get()
+                if batch is _END:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                if event is not None:
+                    compute_stream = torch.cuda.current_stream(self.device)
+                    compute_stream.wait_event(event)
+                    _record_stream(batch, compute_stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,79 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Ranking utilities for pairwise reward models (PairRM, Better-PairRM, SteamSHP) on best of n (BoN)
+
+from typing import Any, Callable, List, Sequence
+
+
+def knockout_tournament(
+    groups: Sequence[Sequence[Any]],
+    compare_fn: Callable[[List[Any], List[Any]], Sequence[Any]],
+    batch_size: int = 64,
+) -> List[List[int]]:
+    """
+    Select the best candidate of every group with a seeded single-elimination bracket.
+
+    A group of N candidates is decided with N - 1 comparisons in ceil(log2(N)) rounds, instead of the N^2
+    comparisons of a full round robin. Candidates are seeded in their original order, so candidate 0 meets
+    candidate 1, 2 meets 3, etc., and with an odd number of entrants the last one gets a bye.
+    All matches of a round are batched across groups before they are passed to `compare_fn`.
+
+    Args:
+        groups: list of candidate lists, one per prompt (e.g. the conversations of each of the n completions).
+        compare_fn: callable taking two equally long lists of candidates and returning, for each pair,
+            a truthy value if the first candidate is better (e.g. `PairRMPipeline.__call__`).
+        batch_size: maximum number of pairs passed to `compare_fn` at once.
+
+    Returns:
+        wins: for every group, the number of rounds each candidate advanced (matches won plus byes).
+            The winner of the group is the unique candidate with the maximum (`argmax` recovers the best of n).
+    """
+    wins = [[0] * len(group) for group in groups]
+    # indices of the candidates that are still in the bracket, per group
+    alive = [list(range(len(group))) for group in groups]
+
+    while any(len(entrants) > 1 for entrants in alive):
+        # collect all matches of this round across groups
+        matches = []
+        for g, entrants in enumerate(alive):
+            for i in range(0, len(entrants) - 1, 2):
+                matches.append((g, entrants[i], entrants[i + 1]))
+
+        outcomes = []
+        for start in range(0, len(matches), batch_size):
+            chunk = matches[start : start + batch_size]
+            candidates_A = [groups[g][a] for g, a, _ in chunk]
+            candidates_B = [groups[g][b] for g, _, b in chunk]
+            outcomes.extend(bool(o) for o in compare_fn(candidates_A, candidates_B))
+        assert len(outcomes) == len(matches), "compare_fn must return one outcome per pair"
+
+        # advance winners (and byes) to the next round, keeping the bracket order
+        next_alive = [[] for _ in alive]
+        match_idx = 0
+        for g, entrants in enumerate(alive):
+            for i in range(0, len(entrants) - 1, 2):
+                _, a, b = matches[match_idx]
+                winner = a if outcomes[match_idx] else b
+                wins[g][winner] += 1
+                next_alive[g].append(winner)
+                match_idx += 1
+            if len(entrants) % 2 == 1:
+                # byes count as an advanced round so the champion always has the most wins
+                if len(entrants) > 1:
+                    wins[g][entrants[-1]] += 1
+                next_alive[g].append(entrants[-1])
+        alive = next_alive
+
+    return wins
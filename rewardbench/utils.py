@@ -15,7 +15,7 @@
 import json
 import logging
 import os
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import pandas as pd
 from datasets import Dataset, Value, concatenate_datasets, load_dataset, load_from_disk
@@ -65,6 +65,87 @@ def check_tokenizer_chat_template(tokenizer):
     return False
 
 
+def deduplicate_texts(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    Map texts to the list of distinct texts (in first-seen order) with a hash map.
+    Returns the unique texts and, for every input text, the index of its unique text, so scores computed once per
+    unique text are scattered back with `scores[inverse]`.
+    """
+    text_to_index = {}
+    inverse = []
+    for text in texts:
+        inverse.append(text_to_index.setdefault(text, len(text_to_index)))
+    return list(text_to_index), inverse
+
+
+def shard_indices(
+    num_examples: int, num_shards: int, shard_index: int, group_keys: Optional[List[Any]] = None
+) -> List[int]:
+    """
+    Row indices of one of `num_shards` deterministic, contiguous shards of a dataset, with sizes differing by at most
+    one (as `datasets.Dataset.shard(contiguous=True)`). With `group_keys` (one hashable key per row), whole groups
+    are sharded instead of rows, e.g. to keep the n completions of a prompt in the same shard for best of n.
+    """
+    assert 0 <= shard_index < num_shards, f"shard_index must be in [0, {num_shards})"
+    if group_keys is None:
+        group_keys = range(num_examples)
+    groups = {}
+    for i, key in enumerate(group_keys):
+        groups.setdefault(key, []).append(i)
+    groups = list(groups.values())
+
+    shard_size, remainder = divmod(len(groups), num_shards)
+    start = shard_size * shard_index + min(shard_index, remainder)
+    end = start + shard_size + (1 if shard_index < remainder else 0)
+    return sorted(i for group in groups[start:end] for i in group)
+
+
+def shard_path(shard_dir: str, shard_index: int, num_shards: int) -> str:
+    return os.path.join(shard_dir, f"shard-{shard_index:05d}-of-{num_shards:05d}.json")
+
+
+def save_shard(
+    rows: Dict[str, List], indices: List[int], shard_dir: str, shard_index: int, num_shards: int, metadata: Dict
+) -> str:
+    """
+    Save the output rows (dict of columns) of one shard with their row indices in the full dataset.
+    """
+    path = shard_path(shard_dir, shard_index, num_shards)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"metadata": metadata, "indices": indices, "rows": rows}, f)
+    return path
+
+
+def load_shards(shard_dir: str, num_shards: int) -> Tuple[Dict[str, List], Dict]:
+    """
+    Merge the outputs of all shards saved with `save_shard` back into dataset order.
+
+    Returns:
+        rows: dict of columns of the full dataset.
+        metadata: metadata of the first shard (e.g. model and model type).
+    """
+    paths = [shard_path(shard_dir, i, num_shards) for i in range(num_shards)]
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing shard outputs: {missing}")
+
+    indices, columns, metadata = [], {}, None
+    for path in paths:
+        with open(path, "r") as f:
+            shard = json.load(f)
+        metadata = metadata if metadata is not None else shard["metadata"]
+        indices.extend(shard["indices"])
+        for key, values in shard["rows"].items():
+            columns.setdefault(key, []).extend(values)
+
+    if sorted(indices) != list(range(len(indices))):
+        raise ValueError(f"Shards in {shard_dir} do not partition the dataset, were they run with other settings?")
+    order = sorted(range(len(indices)), key=lambda i: indices[i])
+    rows = {key: [values[i] for i in order] for key, values in columns.items()}
+    return rows, metadata
+
+
 def save_to_hub(
     results_dict: Union[Dict, List],
     model_name: str,
@@ -371,7 +452,7 @@ def load_bon_dataset(
             ]
             return example
 
-        dataset = raw_dataset.map(
+        dataset = unrolled_dataset.map(
             map_conversations_ift,
             # fn_kwargs={"core_set": core_set},
             num_proc=8,
@@ -0,0 +1,143 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# benchmark the request throughput of the generative judge client (used by run_generative.py), by default against
+# the local mock judge server, so concurrency and backoff changes can be measured without paying for API calls
+# Examples:
+# python scripts/benchmark_judge.py --num_requests 2000 --max_concurrency 128 --latency 0.2 --rate_limit_prob 0.02
+# python scripts/benchmark_judge.py --model claude-3-haiku-20240307
+# python scripts/benchmark_judge.py --model meta-llama/Meta-Llama-3-8B-Instruct --base_url http://localhost:8000/v1
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from rewardbench import generative
+from rewardbench.generative import (
+    ANTHROPIC_MODEL_LIST,
+    API_ERROR_OUTPUT,
+    AsyncJudgeClient,
+    format_judge_answers,
+    process_judgement,
+)
+from rewardbench.mock_judge import MockJudgeServer
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="gpt-4-turbo", help="judge model (selects the API format)")
+    parser.add_argument(
+        "--base_url", type=str, default=None, help="benchmark this OpenAI-compatible server instead of the mock"
+    )
+    parser.add_argument("--num_requests", type=int, default=1000, help="number of judge requests")
+    parser.add_argument("--max_concurrency", type=int, default=64, help="maximum number of requests in flight")
+    parser.add_argument("--requests_per_minute", type=int, default=None, help="client rate limit on requests")
+    parser.add_argument("--tokens_per_minute", type=int, default=None, help="client rate limit on tokens")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock server: seconds per request")
+    parser.add_argument("--latency_jitter", type=float, default=0.05, help="mock server: max extra latency")
+    parser.add_argument("--rate_limit_prob", type=float, default=0.0, help="mock server: fraction of 429 answers")
+    parser.add_argument("--retry_after", type=float, default=None, help="mock server: retry-after of 429 answers")
+    parser.add_argument(
+        "--retry_sleep",
+        type=float,
+        default=None,
+        help=f"base of the exponential backoff in seconds (default: {generative.API_RETRY_SLEEP})",
+    )
+    parser.add_argument("--output", type=str, default=None, help="also write the report to this JSON file")
+    return parser.parse_args()
+
+
+def judge_prompts(index):
+    # distinct prompts of realistic length, so the mock answers vary
+    question = f"Question {index}: " + "Explain the difference between a list and a tuple in Python. " * 4
+    answer_a = [{"role": "user", "content": question}, {"role": "assistant", "content": "A list is mutable. " * 40}]
+    answer_b = [{"role": "user", "content": question}, {"role": "assistant", "content": "A tuple is fixed. " * 40}]
+    return format_judge_answers(question, answer_a, answer_b)
+
+
+async def benchmark(args, base_url, api_key):
+    client = AsyncJudgeClient(
+        args.model,
+        max_concurrency=args.max_concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        base_url=base_url,
+        api_key=api_key,
+    )
+    latencies = [None] * args.num_requests
+
+    async def request(index):
+        system_prompt, user_prompt = judge_prompts(index)
+        start = time.monotonic()
+        judgement = await client.judge(system_prompt, user_prompt, temperature=0, max_tokens=client.max_tokens)
+        # latency as seen by the caller, including rate limiting and retries
+        latencies[index] = time.monotonic() - start
+        return judgement
+
+    try:
+        start = time.monotonic()
+        judgements = await asyncio.gather(*(request(i) for i in range(args.num_requests)))
+        elapsed = time.monotonic() - start
+    finally:
+        await client.close()
+
+    latencies = np.array(latencies)
+    return {
+        "model": args.model,
+        "num_requests": args.num_requests,
+        "max_concurrency": args.max_concurrency,
+        "seconds": elapsed,
+        "requests_per_second": args.num_requests / elapsed,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "rate_limits": client.num_rate_limits,
+        "retries": client.num_retries,
+        "errors": sum(judgement == API_ERROR_OUTPUT for judgement in judgements),
+        "unparsed": sum(process_judgement(judgement) == "error" for judgement in judgements),
+        "final_concurrency": client.limiter.limit,
+    }
+
+
+def main():
+    args = get_args()
+    if args.retry_sleep is not None:
+        generative.API_RETRY_SLEEP = args.retry_sleep
+
+    if args.base_url is not None:
+        report = asyncio.run(benchmark(args, args.base_url, None))
+    else:
+        with MockJudgeServer(
+            latency=args.latency,
+            latency_jitter=args.latency_jitter,
+            rate_limit_prob=args.rate_limit_prob,
+            retry_after=args.retry_after,
+        ) as server:
+            # the Anthropic client adds the /v1 prefix itself
+            base_url = server.url if args.model in ANTHROPIC_MODEL_LIST else server.url + "/v1"
+            report = asyncio.run(benchmark(args, base_url, "mock"))
+            report["server_requests"] = server.num_requests
+            report["server_rate_limited"] = server.num_rate_limited
+
+    for key, value in report.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
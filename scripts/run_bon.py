@@ -24,6 +24,7 @@ import torch
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
+from datasets import Dataset
 from fastchat.conversation import get_conv_template
 from tqdm import tqdm
 from transformers import AutoTokenizer, pipeline
@@ -34,6 +35,11 @@ from rewardbench import (
     load_bon_dataset,
     save_to_hub,
 )
+from rewardbench.cache import ScoreCache
+from rewardbench.models import RewardPipeline
+from rewardbench.prefetch import BatchPrefetcher
+from rewardbench.ranking import knockout_tournament
+from rewardbench.utils import load_shards, save_shard, shard_indices
 
 # get token from HF_TOKEN env variable, but if it doesn't exist pass none
 HF_TOKEN = os.getenv("HF_TOKEN", None)
@@ -58,13 +64,89 @@ def get_args():
     parser.add_argument("--do_not_save", action="store_true", help="do not save results to hub (for debugging)")
     parser.add_argument("--batch_size", type=int, default=64, help="batch size for inference")
     parser.add_argument("--best_of", type=int, default=16, help="number of best of n to select from")
+    parser.add_argument(
+        "--num_workers", type=int, default=4, help="dataloader workers tokenizing batches for custom pipelines"
+    )
+    parser.add_argument(
+        "--score_cache", type=str, default=None, help="SQLite file caching scores across runs (e.g. scores.db)"
+    )
     parser.add_argument(
         "--debug", action="store_true", help="run on common preference sets instead of our custom eval set"
     )
+    parser.add_argument("--num_shards", type=int, default=1, help="split the dataset into shards run as separate jobs")
+    parser.add_argument("--shard_index", type=int, default=0, help="index of the shard scored by this job")
+    parser.add_argument("--shard_dir", type=str, default="results/shards", help="directory of the shard outputs")
+    parser.add_argument(
+        "--merge_shards", action="store_true", help="merge the outputs of --num_shards shards and save the results"
+    )
     args = parser.parse_args()
     return args
 
 
+def save_results(args, out_dataset, logger):
+    """
+    Split the scored completions per subset and generator model and save them.
+    """
+    alpaca_eval = out_dataset.filter(lambda x: x["subset"] == "alpaca_eval")
+    mt_bench = out_dataset.filter(lambda x: x["subset"] == "mt_bench")
+
+    # remove subset column from both
+    alpaca_eval = alpaca_eval.remove_columns("subset")
+    mt_bench = mt_bench.remove_columns("subset")
+
+    # remove model_input
+    alpaca_eval = alpaca_eval.remove_columns("model_input")
+    mt_bench = mt_bench.remove_columns("model_input")
+
+    # split into per-model
+    alpaca_eval_zephyr = alpaca_eval.filter(lambda x: x["model"] == "HuggingFaceH4/zephyr-7b-beta")
+    alpaca_eval_tulu = alpaca_eval.filter(lambda x: x["model"] == "allenai/tulu-2-dpo-13b")
+    mt_bench_zephyr = mt_bench.filter(lambda x: x["model"] == "HuggingFaceH4/zephyr-7b-beta")
+    mt_bench_tulu = mt_bench.filter(lambda x: x["model"] == "allenai/tulu-2-dpo-13b")
+
+    # def flatten and to dict
+    def flatten_data(dataset):
+        dictionary = dataset.to_dict()
+        return [dict(zip(dictionary.keys(), values)) for values in zip(*dictionary.values())]
+
+    ############################
+    # Upload results to hub
+    ############################
+    sub_path = "best-of-n/"
+    results_url = save_to_hub(
+        flatten_data(alpaca_eval_zephyr),
+        args.model,
+        sub_path + "alpaca_eval/zephyr-7b/",
+        args.debug,
+        local_only=args.do_not_save,
+    )
+    results_url_2 = save_to_hub(
+        flatten_data(alpaca_eval_tulu),
+        args.model,
+        sub_path + "alpaca_eval/tulu-13b/",
+        args.debug,
+        local_only=args.do_not_save,
+    )
+    results_url_3 = save_to_hub(
+        flatten_data(mt_bench_zephyr),
+        args.model,
+        sub_path + "mt_bench/zephyr-7b/",
+        args.debug,
+        local_only=args.do_not_save,
+    )
+    results_url_4 = save_to_hub(
+        flatten_data(mt_bench_tulu),
+        args.model,
+        sub_path + "mt_bench/tulu-13/",
+        args.debug,
+        local_only=args.do_not_save,
+    )
+    if not args.do_not_save:
+        logger.info(
+            f"Uploaded reward model results to {results_url}, {results_url_2}, {results_url_3}, {results_url_4}"
+        )
+
+
 def main():
     args = get_args()
     ###############
@@ -108,13 +190,20 @@ def main():
 
     quantized = config["quantized"]  # only Starling isn't quantized for now
     custom_dialogue = config["custom_dialogue"]
-    _ = config["model_type"]  # todo will be needed to add PairRM and SteamSHP
+    model_type = config["model_type"]
     model_builder = config["model_builder"]
     pipeline_builder = config["pipeline_builder"]
 
     # not included in config to make user explicitly understand they are passing this
     trust_remote_code = args.trust_remote_code
 
+    shard_dir = os.path.join(args.shard_dir, "best-of-n", args.model)
+    if args.merge_shards:
+        logger.info(f"*** Merging {args.num_shards} shards from {shard_dir} ***")
+        rows, _ = load_shards(shard_dir, args.num_shards)
+        save_results(args, Dataset.from_dict(rows), logger)
+        return
+
     ############################
     # Load dataset
     ############################
@@ -139,6 +228,18 @@ def main():
         dataset = dataset.select(range(10))
         ids = ids[:10]
 
+    # shard: a deterministic, contiguous slice of the prompts scored by this job
+    # (the n completions of a prompt stay together, as needed by the pairwise tournament)
+    if args.num_shards > 1:
+        group_keys = [
+            (subset, generator, row_id[0])
+            for subset, generator, row_id in zip(dataset["subset"], dataset["model"], ids)
+        ]
+        shard = shard_indices(len(dataset), args.num_shards, args.shard_index, group_keys=group_keys)
+        dataset = dataset.select(shard)
+        ids = [ids[i] for i in shard]
+        logger.info(f"Running shard {args.shard_index}/{args.num_shards} with {len(shard)} completions")
+
     ############################
     # Load reward model pipeline
     ############################
@@ -184,32 +285,91 @@ def main():
         reward_pipe.tokenizer.add_eos_token = True
 
     ############################
-    # Run inference [1/2]" built in transformers
+    # Score cache, only texts with a missing score are sent to the model
+    ############################
+    score_cache = None
+    cached_scores = [None] * len(dataset)
+    if args.score_cache is not None:
+        if model_type == "Custom Classifier":
+            logger.info("Score cache only supports models scoring single texts, running the full tournament")
+        else:
+            score_cache = ScoreCache(
+                args.score_cache,
+                args.model,
+                revision=getattr(reward_pipe.model.config, "_commit_hash", None),
+                tokenizer=tokenizer,
+                max_length=reward_pipeline_kwargs["max_length"],
+                # everything else that changes the scores, so different settings never share cached scores
+                options={
+                    "pipeline": type(reward_pipe).__name__,
+                    "quantized": quantized,
+                    "dtype": reward_pipe.model.dtype,
+                    "truncation": reward_pipeline_kwargs["truncation"],
+                    "add_eos_token": getattr(reward_pipe.tokenizer, "add_eos_token", None),
+                },
+            )
+            cached_scores = score_cache.get(dataset["text"])
+    todo = [i for i, score in enumerate(cached_scores) if score is None]
+    if score_cache is not None:
+        logger.info(f"{len(dataset) - len(todo)}/{len(dataset)} texts found in the score cache")
+    score_dataset = dataset.select(todo) if len(todo) < len(dataset) else dataset
+
+    ############################
+    # Run inference [1/3]" built in transformers
     ############################
     # if using HF pipeline, can pass entire dataset and get results
     # first, handle custom pipelines that we must batch normally
-    if pipeline_builder == pipeline:
+    if len(score_dataset) == 0:
+        scores = []
+    elif pipeline_builder == pipeline:
         logger.info("*** Running forward pass via built in pipeline abstraction ***")
         # this setup can be optimized slightly with one pipeline call
         # prepare for inference
         reward_pipe = accelerator.prepare(reward_pipe)
 
-        results = reward_pipe(dataset["text"], **reward_pipeline_kwargs)
+        results = reward_pipe(score_dataset["text"], **reward_pipeline_kwargs)
 
         # extract scores from results which is list of dicts, e.g. [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
         scores = [r["score"] for r in results]
 
     ############################
-    # Run inference [2/2] custom pipelines
+    # Run inference [2/3] pairwise custom pipelines (PairRM, SteamSHP)
+    ############################
+    elif model_type == "Custom Classifier":
+        logger.info("*** Running knockout tournament for pairwise reward model ***")
+        reward_pipe.model = accelerator.prepare(reward_pipe.model)
+
+        # group the n completions of every prompt, ids are [prompt id, completion index]
+        groups = {}
+        for i, (subset, generator, row_id) in enumerate(zip(dataset["subset"], dataset["model"], ids)):
+            groups.setdefault((subset, generator, row_id[0]), []).append(i)
+        groups = list(groups.values())
+
+        texts = dataset["text"]
+
+        def compare(candidates_A, candidates_B):
+            return reward_pipe(candidates_A, candidates_B, **reward_pipeline_kwargs).tolist()
+
+        wins = knockout_tournament([[texts[i] for i in group] for group in groups], compare, batch_size=BATCH_SIZE)
+
+        # the score of each completion is the number of rounds it advanced, the best of n has the max score
+        scores = [0] * len(dataset)
+        for group, group_wins in zip(groups, wins):
+            for i, w in zip(group, group_wins):
+                scores[i] = w
+
+    ############################
+    # Run inference [3/3] custom pipelines
     ############################
     else:
         logger.info("*** Running dataloader to collect results ***")
-        # TODO make more custom pipelines work with pre-tokenized data
         from torch.utils.data.dataloader import default_collate
 
-        # for PairRM, hmm, will move all of this later
         def custom_collate_fn(batch):
-            # check if ['text_chosen'] is in first batch element
+            # pipelines with a `preprocess` step are tokenized here, in the dataloader workers,
+            # so tokenization of the next batches overlaps with the forward passes
+            if isinstance(reward_pipe, RewardPipeline):
+                return {"text": reward_pipe.preprocess([b["text"] for b in batch], **reward_pipeline_kwargs)}
             # Check if the first element of the batch is a dictionary
             if isinstance(batch[0]["text"][0], dict):
                 return batch  # Return the batch as-is if it's a list of dicts
@@ -217,35 +377,43 @@ def main():
                 return default_collate(batch)  # Use the default collate behavior otherwise
 
         dataloader = torch.utils.data.DataLoader(
-            dataset,
+            score_dataset,
             batch_size=BATCH_SIZE,
             collate_fn=custom_collate_fn,  # if not args.pref_sets else None,
             shuffle=False,
             drop_last=False,
+            num_workers=args.num_workers,
         )
 
         dataloader, model = accelerator.prepare(dataloader, reward_pipe.model)
         reward_pipe.model = model
+        # fetch the next batches in the background while the current one is scored
+        dataloader = BatchPrefetcher(dataloader)
 
         scores = []
         for step, batch in enumerate(tqdm(dataloader, desc="RM batch steps")):
             logger.info(f"RM inference step {step}/{len(dataloader)}")
 
-            if "PairRM" in args.model or "SteamSHP" in args.model:
-                raise NotImplementedError("PairRM and SteamSHP are not yet supported for batched inference")
+            rewards = reward_pipe(batch["text"], **reward_pipeline_kwargs)
+
+            # for each item in batch, record 1 if chosen > rejected
+            # extra score from dict within batched results (e.g. logits)
+            # [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
+            if isinstance(rewards[0], dict):
+                scores_batch = [result["score"] for result in rewards]
+            # for classes that directly output scores (custom code)
             else:
-                rewards = reward_pipe(batch["text"], **reward_pipeline_kwargs)
+                scores_batch = rewards.cpu().numpy().tolist()
 
-                # for each item in batch, record 1 if chosen > rejected
-                # extra score from dict within batched results (e.g. logits)
-                # [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
-                if isinstance(rewards[0], dict):
-                    scores_batch = [result["score"] for result in rewards]
-                # for classes that directly output scores (custom code)
-                else:
-                    scores_batch = rewards.cpu().numpy().tolist()
+            scores.extend(scores_batch)
 
-                scores.extend(scores_batch)
+    if score_cache is not None:
+        score_cache.put(score_dataset["text"], scores)
+        score_cache.close()
+        # merge new and cached scores in dataset order
+        for i, score in zip(todo, scores):
+            cached_scores[i] = score
+        scores = cached_scores
 
     ############################
     # Print & process results
@@ -260,64 +428,14 @@ def main():
     # will get these from the source dataset when loading
     out_dataset = out_dataset.remove_columns("text")
 
-    alpaca_eval = out_dataset.filter(lambda x: x["subset"] == "alpaca_eval")
-    mt_bench = out_dataset.filter(lambda x: x["subset"] == "mt_bench")
+    if args.num_shards > 1:
+        # save the scored rows of this shard, results are saved once all shards are merged
+        metadata = {"model": args.model, "model_type": model_type}
+        path = save_shard(out_dataset.to_dict(), shard, shard_dir, args.shard_index, args.num_shards, metadata)
+        logger.info(f"Saved shard {args.shard_index}/{args.num_shards} to {path}")
+        return
 
-    # remove subset column from both
-    alpaca_eval = alpaca_eval.remove_columns("subset")
-    mt_bench = mt_bench.remove_columns("subset")
-
-    # remove model_input
-    alpaca_eval = alpaca_eval.remove_columns("model_input")
-    mt_bench = mt_bench.remove_columns("model_input")
-
-    # split into per-model
-    alpaca_eval_zephyr = alpaca_eval.filter(lambda x: x["model"] == "HuggingFaceH4/zephyr-7b-beta")
-    alpaca_eval_tulu = alpaca_eval.filter(lambda x: x["model"] == "allenai/tulu-2-dpo-13b")
-    mt_bench_zephyr = mt_bench.filter(lambda x: x["model"] == "HuggingFaceH4/zephyr-7b-beta")
-    mt_bench_tulu = mt_bench.filter(lambda x: x["model"] == "allenai/tulu-2-dpo-13b")
-
-    # def flatten and to dict
-    def flatten_data(dataset):
-        dictionary = dataset.to_dict()
-        return [dict(zip(dictionary.keys(), values)) for values in zip(*dictionary.values())]
-
-    ############################
-    # Upload results to hub
-    ############################
-    sub_path = "best-of-n/"
-    results_url = save_to_hub(
-        flatten_data(alpaca_eval_zephyr),
-        args.model,
-        sub_path + "alpaca_eval/zephyr-7b/",
-        args.debug,
-        local_only=args.do_not_save,
-    )
-    results_url_2 = save_to_hub(
-        flatten_data(alpaca_eval_tulu),
-        args.model,
-        sub_path + "alpaca_eval/tulu-13b/",
-        args.debug,
-        local_only=args.do_not_save,
-    )
-    results_url_3 = save_to_hub(
-        flatten_data(mt_bench_zephyr),
-        args.model,
-        sub_path + "mt_bench/zephyr-7b/",
-        args.debug,
-        local_only=args.do_not_save,
-    )
-    results_url_4 = save_to_hub(
-        flatten_data(mt_bench_tulu),
-        args.model,
-        sub_path + "mt_bench/tulu-13/",
-        args.debug,
-        local_only=args.do_not_save,
-    )
-    if not args.do_not_save:
-        logger.info(
-            f"Uploaded reward model results to {results_url}, {results_url_2}, {results_url_3}, {results_url_4}"
-        )
+    save_results(args, out_dataset, logger)
 
 
 if __name__ == "__main__":
@@ -36,6 +36,7 @@ sys.path.append(path)
 
 from rewardbench import DPO_MODEL_CONFIG, DPOInference, load_eval_dataset, save_to_hub
 from rewardbench.constants import EXAMPLE_COUNTS, SUBSET_MAPPING
+from rewardbench.prefetch import BatchPrefetcher
 from rewardbench.utils import calculate_scores_per_section
 
 
@@ -214,6 +215,8 @@ def evalution_acc_original_reward(args):
         shuffle=False,
         drop_last=False,
     )
+    # collate and copy the next batches to the device in the background while the current one is scored
+    dataloader = BatchPrefetcher(dataloader, device=accelerator.device)
     results = []
     scores_chosen = []
     scores_rejected = []
@@ -434,6 +437,8 @@ def evaluation_reconstruct_reward(args,tie_type="tie_loss"):
         shuffle=False,
         drop_last=False,
     )
+    # collate and copy the next batches to the device in the background while the current one is scored
+    dataloader = BatchPrefetcher(dataloader, device=accelerator.device)
     chosen_max_results=[]
     scores_chosen = []
     scores_tie = []
@@ -678,6 +683,8 @@ def evaluation_ceartain_acc_of_train_and_valid(args,tie_type):
         shuffle=False,
         drop_last=False,
     )
+    # collate and copy the next batches to the device in the background while the current one is scored
+    dataloader = BatchPrefetcher(dataloader, device=accelerator.device)
     results = []
     scores_chosen = []
     scores_tie = []
@@ -869,6 +876,8 @@ def evaluation_ceartain_acc_of_train_and_valid_orrginal_reward(args):
         shuffle=False,
         drop_last=False,
     )
+    # collate and copy the next batches to the device in the background while the current one is scored
+    dataloader = BatchPrefetcher(dataloader, device=accelerator.device)
     results = []
     scores_chosen = []
     scores_tie = []
@@ -16,28 +16,39 @@
 # Examples:
 # python scripts/run_generative.py --model gpt-3.5-turbo
 # python scripts/run_generative.py --model=claude-3-haiku-20240307
+# python scripts/run_generative.py --model=meta-llama/Meta-Llama-3-70B-Instruct --base_url=http://localhost:8000/v1
 
-# note: for none API models, this script uses vllm
+# note: for none API models, this script uses vllm by default (or transformers with --backend transformers)
 # pip install vllm
 
 import argparse
+import asyncio
+import json
 import logging
 import os
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 from fastchat.conversation import get_conv_template
 from transformers import AutoTokenizer
-from vllm import LLM, SamplingParams
 
 from rewardbench import load_eval_dataset, save_to_hub
+from rewardbench.cache import JudgementCache
 from rewardbench.constants import EXAMPLE_COUNTS, SUBSET_MAPPING
 from rewardbench.generative import (
     API_MODEL_LIST,
+    VERDICT_PREFIX,
+    AsyncJudgeClient,
+    JudgementLog,
+    TransformersJudge,
+    batch_custom_id,
+    format_batch_request,
     format_judge_answers,
+    judgement_log_path,
+    load_batch_results,
     process_judgement,
-    run_judge_pair,
+    process_verdict_logprobs,
+    run_judge_pair_async,
 )
 from rewardbench.utils import calculate_scores_per_section
 
@@ -49,6 +60,9 @@ if HF_TOKEN is not None:
 
     _login(token=HF_TOKEN, add_to_git_credential=False)
 
+# number of top logprobs returned at the verdict position (the default limit of vLLM)
+VERDICT_TOP_LOGPROBS = 20
+
 
 def get_args():
     """
@@ -71,7 +85,73 @@ def get_args():
         "--debug", action="store_true", help="run on common preference sets instead of our custom eval set"
     )
     parser.add_argument(
-        "--num_threads", type=int, default=10, help="number of threads to use for parallel processing of examples"
+        "--num_threads", type=int, default=10, help="maximum number of concurrent API requests (adapted to 429s)"
+    )
+    parser.add_argument(
+        "--requests_per_minute", type=int, default=None, help="API request rate limit of the provider (optional)"
+    )
+    parser.add_argument(
+        "--tokens_per_minute", type=int, default=None, help="API token rate limit of the provider (optional)"
+    )
+    parser.add_argument(
+        "--judgement_cache", type=str, default=None, help="SQLite file caching judgements across runs (e.g. judge.db)"
+    )
+    parser.add_argument("--seed", type=int, default=42, help="seed of the per-example A/B order shuffle")
+    parser.add_argument(
+        "--judgement_log",
+        type=str,
+        default=None,
+        help="JSONL file receiving every API judgement as it arrives (default: results/judgement-logs/..., per run)",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="skip the examples already judged in --judgement_log (API models)"
+    )
+    parser.add_argument(
+        "--overwrite_log", action="store_true", help="replace a non-empty, explicit --judgement_log instead of failing"
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="OpenAI-compatible server (vLLM, llama.cpp, TGI) serving --model, judged like an API model",
+    )
+    parser.add_argument(
+        "--api_key", type=str, default=None, help="key of --base_url (default: OPENAI_API_KEY or EMPTY)"
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="vllm",
+        choices=["vllm", "transformers"],
+        help="inference backend of local models, transformers runs without vllm (e.g. on CPU)",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="batch size of the transformers backend (vllm schedules itself)"
+    )
+    parser.add_argument(
+        "--export_batch",
+        type=str,
+        default=None,
+        help="API models: write all judge requests to this provider batch file (JSONL) and exit",
+    )
+    parser.add_argument(
+        "--ingest_batch", type=str, default=None, help="API models: score from this provider batch results file"
+    )
+    parser.add_argument(
+        "--dual_order",
+        action="store_true",
+        help="local judges: judge every pair in both A/B orders and average, instead of one random order",
+    )
+    parser.add_argument(
+        "--verdict_logprobs",
+        action="store_true",
+        help="local judges: force the verdict and score it from the logprobs of A / B instead of generating",
+    )
+    parser.add_argument(
+        "--verdict_rationale_tokens",
+        type=int,
+        default=0,
+        help="with --verdict_logprobs, max tokens of rationale generated before the forced verdict (0 for none)",
     )
     parser.add_argument(
         "--disable_beaker_save", action="store_true", help="disable saving the main results in a file for AI2 Beaker"
@@ -100,23 +180,58 @@ def main():
     conv = get_conv_template("raw")  # not used
     custom_dialogue = True  # to mirror other scripts, required here
     model_type = "Generative RM"
+    # models behind an OpenAI-compatible endpoint are queried like API models, several jobs can share one server
+    use_api = args.model in API_MODEL_LIST or args.base_url is not None
 
-    # if model isn't API, load via vllm
-    if args.model not in API_MODEL_LIST:
-        # load model
-        model = LLM(args.model, trust_remote_code=args.trust_remote_code, tensor_parallel_size=args.num_gpus)
+    # if model isn't API, load via vllm (or transformers)
+    if not use_api:
         tokenizer = AutoTokenizer.from_pretrained(args.model)
         if "Llama-3" in args.model or "llama3-8b" in args.model:
             stop_token_ids = [128009]
         else:
             stop_token_ids = []
-        sampling_params = SamplingParams(
-            n=1,
-            temperature=0,
-            top_p=1,
-            max_tokens=1024,
-            stop_token_ids=stop_token_ids,
-        )
+        # the verdict closes the judgement, stop there instead of generating up to max_tokens
+        stop = ["]]"] if args.dual_order or args.backend == "transformers" else None
+
+        if args.backend == "vllm":
+            # imported here, so the transformers backend does not require vllm
+            from vllm import LLM, SamplingParams
+
+            # load model
+            # prompts sharing a prefix (both orders of a pair, a rationale and its verdict) reuse its KV cache
+            model = LLM(
+                args.model,
+                trust_remote_code=args.trust_remote_code,
+                tensor_parallel_size=args.num_gpus,
+                enable_prefix_caching=args.dual_order or args.verdict_logprobs,
+            )
+            sampling_params = SamplingParams(
+                n=1,
+                temperature=0,
+                top_p=1,
+                max_tokens=1024,
+                stop_token_ids=stop_token_ids,
+                stop=stop,
+                include_stop_str_in_output=stop is not None,
+            )
+            if args.verdict_logprobs:
+                # a short (optional) rationale, then one token after the forced verdict prefix, read from its logprobs
+                rationale_params = SamplingParams(
+                    n=1,
+                    temperature=0,
+                    top_p=1,
+                    max_tokens=max(args.verdict_rationale_tokens, 1),
+                    stop=[VERDICT_PREFIX],
+                    stop_token_ids=stop_token_ids,
+                    include_stop_str_in_output=True,
+                )
+                verdict_params = SamplingParams(n=1, temperature=0, max_tokens=1, logprobs=VERDICT_TOP_LOGPROBS)
+        else:
+            model = TransformersJudge(args.model, batch_size=args.batch_size, trust_remote_code=args.trust_remote_code)
+    elif args.verdict_logprobs or args.dual_order:
+        raise ValueError("--verdict_logprobs and --dual_order are only supported for local models")
+    if args.model not in API_MODEL_LIST and (args.export_batch is not None or args.ingest_batch is not None):
+        raise ValueError("--export_batch and --ingest_batch are only supported for API models")
 
     ############################
     # Load dataset
@@ -142,7 +257,74 @@ def main():
         subsets = subsets[:10]
         ids = ids[:10]
 
-    if args.model in API_MODEL_LIST:
+    def shuffle_order(index):
+        # deterministic per example (and seed), so re-runs send the same prompts and hit the judgement cache
+        return np.random.default_rng([args.seed, index]).random() > 0.5
+
+    def process_shuffled(win, shuffle):
+        if shuffle:
+            winner_text = "B"
+            loser_text = "A"
+        else:
+            winner_text = "A"
+            loser_text = "B"
+
+        if win == winner_text:
+            return 1
+        elif win == loser_text:
+            return 0
+        else:  # if "error"
+            return 0.5  # effectively a tie
+
+    judgement_cache = JudgementCache(args.judgement_cache) if args.judgement_cache is not None else None
+
+    if args.export_batch is not None:
+        ############################
+        # Write requests for a provider batch endpoint
+        ############################
+        if os.path.dirname(args.export_batch):
+            os.makedirs(os.path.dirname(args.export_batch), exist_ok=True)
+        num_requests = 0
+        with open(args.export_batch, "w") as f:
+            for index, example in enumerate(dataset):
+                if len(example["text_chosen"]) > 4:  # set up only for 1 or 2 turns, scored as ties
+                    continue
+                answer_a = example["text_chosen"]
+                answer_b = example["text_rejected"]
+                # same order as a direct run, the order is also recorded in the request id
+                is_shuffled = shuffle_order(index)
+                if is_shuffled:
+                    answer_a, answer_b = answer_b, answer_a
+                system_prompt, user_prompt = format_judge_answers(
+                    example["text_chosen"][0]["content"], answer_a, answer_b, multi_turn=len(answer_a) > 2
+                )
+                request = format_batch_request(
+                    batch_custom_id(index, is_shuffled), args.model, system_prompt, user_prompt
+                )
+                f.write(json.dumps(request) + "\n")
+                num_requests += 1
+        logger.info(f"Wrote {num_requests} requests to {args.export_batch}, score the results with --ingest_batch")
+        return
+
+    if args.ingest_batch is not None:
+        ############################
+        # Read the results of a provider batch
+        ############################
+        batch_results = load_batch_results(args.ingest_batch)
+        results = []
+        num_missing = 0
+        for index, example in enumerate(dataset):
+            if index in batch_results:
+                is_shuffled, judgement = batch_results[index]
+                results.append(process_shuffled(process_judgement(judgement), is_shuffled))
+            else:
+                if len(example["text_chosen"]) <= 4:
+                    num_missing += 1
+                results.append(0.5)
+        if num_missing > 0:
+            logger.warning(f"{num_missing} requests missing from {args.ingest_batch}, counted as ties")
+
+    elif use_api:
         ############################
         # Run inference via API
         ############################
@@ -152,14 +334,14 @@ def main():
             sys.stdout.write("\r[{}{}] {}/{}".format("#" * progress, "." * (50 - progress), done, total))
             sys.stdout.flush()
 
-        def get_judgement(batch, debug=args.debug):
+        async def get_judgement(client, index, batch, debug=args.debug):
             mult_turn = True if len(batch["text_chosen"]) > 2 else False
             prompt = batch["text_chosen"][0]["content"]
             answer_a = batch["text_chosen"]
             answer_b = batch["text_rejected"]
 
             # shuffle a and b randomly for position bias
-            is_shuffled = np.random.rand() > 0.5
+            is_shuffled = shuffle_order(index)
             if is_shuffled:
                 answer_a, answer_b = answer_b, answer_a
                 winner_text = "B"
@@ -168,103 +350,228 @@ def main():
                 winner_text = "A"
                 loser_text = "B"
 
+            record = {"index": index, "is_shuffled": bool(is_shuffled), "winner": None, "judgement": None}
             if len(batch["text_chosen"]) <= 4:  # set up only for 1 or 2 turns
-                winner, request, judgement = run_judge_pair(
-                    prompt, answer_a, answer_b, args.model, multi_turn=mult_turn
+                winner, request, judgement = await run_judge_pair_async(
+                    prompt, answer_a, answer_b, client, multi_turn=mult_turn, cache=judgement_cache
                 )
                 if debug:
                     print(f"Prompt: {request}")
                     print(f"Judgement: {judgement}")
+                record["winner"] = winner
+                record["judgement"] = judgement
                 if winner == winner_text:
-                    return 1
+                    record["result"] = 1
                 elif winner == loser_text:
-                    return 0
+                    record["result"] = 0
                 else:  # if "error"
-                    return 0.5  # effectively a tie
+                    record["result"] = 0.5  # effectively a tie
             else:
-                return 0.5
+                record["result"] = 0.5
+            return record
 
-        with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
-            # Map 'my_function' across the vector, executing in parallel using threads
-            # results = list(executor.map(get_judgement, dataset))
+        async def judge_all():
+            # every finished judgement is appended to the log right away, so nothing paid for is lost on a crash
+            if args.judgement_log is not None:
+                judgement_log = JudgementLog(args.judgement_log, resume=args.resume, overwrite=args.overwrite_log)
+            else:
+                # the default log belongs to this configuration, a re-run replaces it unless resuming
+                log_path = judgement_log_path(args.model, args.pref_sets, args.debug, args.seed, args.base_url)
+                judgement_log = JudgementLog(log_path, resume=args.resume, overwrite=True)
+            # one client (and HTTP connection pool) shared by all requests
+            client = AsyncJudgeClient(
+                args.model,
+                max_concurrency=args.num_threads,
+                requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute,
+                base_url=args.base_url,
+                api_key=args.api_key,
+            )
 
-            # Progress bar version
             results = [None] * len(dataset)  # Preallocate results list
-            done_tasks = 0  # Counter for completed tasks
-
-            with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
-                # Submit all tasks and hold their futures in a list
-                future_to_index = {executor.submit(get_judgement, x): i for i, x in enumerate(dataset)}
-
-                # As tasks complete, update progress and store results in the original order
-                for future in as_completed(future_to_index):
-                    index = future_to_index[future]
-                    results[index] = future.result()
+            for index, record in judgement_log.records.items():
+                if index < len(dataset):
+                    results[index] = record["result"]
+            todo = [i for i, result in enumerate(results) if result is None]
+            done_tasks = len(dataset) - len(todo)  # Counter for completed tasks
+
+            async def judge_index(i):
+                return await get_judgement(client, i, dataset[i])
+
+            try:
+                tasks = [asyncio.create_task(judge_index(i)) for i in todo]
+                # As tasks complete, log them, update progress and store results in the original order
+                for task in asyncio.as_completed(tasks):
+                    record = await task
+                    judgement_log.write(record)
+                    results[record["index"]] = record["result"]
                     done_tasks += 1
                     update_progress_bar(done_tasks, len(dataset))
+            finally:
+                judgement_log.close()
+                await client.close()
+            return results
 
-            # Print newline after progress bar
-            print()
+        results = asyncio.run(judge_all())
+
+        # Print newline after progress bar
+        print()
     else:
         ############################
-        # Run model weights with vllm
+        # Run model weights with vllm (or transformers)
         ############################
 
-        def format_judgements(batch):
+        def format_judgements(batch, index):
             # TODO expand this to include fastchat chat templates if needed
             mult_turn = True if len(batch["text_chosen"]) > 2 else False
             prompt = batch["text_chosen"][0]["content"]
-            answer_a = batch["text_chosen"]
-            answer_b = batch["text_rejected"]
-
-            # shuffle a and b randomly for position bias
-            is_shuffled = np.random.rand() > 0.5
-            if is_shuffled:
-                answer_a, answer_b = answer_b, answer_a
 
-            system_prompt, user_prompt = format_judge_answers(prompt, answer_a, answer_b, multi_turn=mult_turn)
-
-            messages = [
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
-                {"role": "user", "content": user_prompt},
-            ]
-            prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-            batch["text"] = prompt
-            batch["is_shuffled"] = is_shuffled
+            # shuffle a and b randomly for position bias, or judge both orders to remove it
+            orders = [False, True] if args.dual_order else [shuffle_order(index)]
+            batch["text"], batch["is_shuffled"], batch["system_prompt"], batch["user_prompt"] = [], [], [], []
+            for is_shuffled in orders:
+                answer_a = batch["text_chosen"]
+                answer_b = batch["text_rejected"]
+                if is_shuffled:
+                    answer_a, answer_b = answer_b, answer_a
+
+                system_prompt, user_prompt = format_judge_answers(prompt, answer_a, answer_b, multi_turn=mult_turn)
+
+                messages = [
+                    {
+                        "role": "system",
+                        "content": system_prompt,
+                    },
+                    {"role": "user", "content": user_prompt},
+                ]
+                prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                batch["text"].append(prompt_text)
+                batch["is_shuffled"].append(bool(is_shuffled))
+                batch["system_prompt"].append(system_prompt)
+                batch["user_prompt"].append(user_prompt)
             return batch
 
         # format the dataset for the model
-        dataset_prompts = dataset.map(format_judgements)
+        dataset_prompts = dataset.map(format_judgements, with_indices=True)
+
+        # collect texts of dataset in one flat list, the orders of an example are next to each other,
+        # so vLLM schedules them together and the second one hits the prefix cache
+        num_orders = 2 if args.dual_order else 1
+        prompts = [text for texts in dataset_prompts["text"] for text in texts]
+        is_shuffled = [shuffle for shuffles in dataset_prompts["is_shuffled"] for shuffle in shuffles]
+
+        def generate_judgements(prompts):
+            if args.backend == "vllm":
+                return [o.outputs[0].text for o in model.generate(prompts, sampling_params)]
+            return model.generate(prompts, max_new_tokens=1024, stop=stop, stop_token_ids=stop_token_ids)
+
+        def judge_verdict_logprobs(prompts):
+            # returns the judgements as JSON with the rationale and the probability that A is better
+            rationales = [""] * len(prompts)
+            if args.verdict_rationale_tokens > 0:
+                if args.backend == "vllm":
+                    texts = [o.outputs[0].text for o in model.generate(prompts, rationale_params)]
+                else:
+                    texts = model.generate(
+                        prompts,
+                        max_new_tokens=args.verdict_rationale_tokens,
+                        stop=[VERDICT_PREFIX],
+                        stop_token_ids=stop_token_ids,
+                    )
+                for j, rationale in enumerate(texts):
+                    # stopped at the verdict prefix (removed, it is forced below), otherwise cut off or ended
+                    if rationale.endswith(VERDICT_PREFIX):
+                        rationale = rationale[: -len(VERDICT_PREFIX)]
+                    else:
+                        rationale = rationale.rstrip() + "\n\n"
+                    rationales[j] = rationale
+            verdict_prompts = [p + r + VERDICT_PREFIX for p, r in zip(prompts, rationales)]
+            if args.backend == "vllm":
+                probs_a = []
+                for o in model.generate(verdict_prompts, verdict_params):
+                    top_logprobs = o.outputs[0].logprobs[0]  # token id -> Logprob at the verdict position
+                    probs_a.append(
+                        process_verdict_logprobs(
+                            (tokenizer.decode([token_id]), logprob.logprob)
+                            for token_id, logprob in top_logprobs.items()
+                        )
+                    )
+            else:
+                probs_a = model.verdict_probabilities(verdict_prompts, top_k=VERDICT_TOP_LOGPROBS)
+            return [json.dumps({"rationale": r, "prob_a": p}) for r, p in zip(rationales, probs_a)]
 
-        # collect texts of dataset in list
-        prompts = dataset_prompts["text"]
-        is_shuffled = dataset_prompts["is_shuffled"]
+        # only generate judgements missing from the cache, keyed on everything the outputs depend on: the backends
+        # and precisions do not generate identical judgements, and the verdict modes store different answers
+        if args.backend == "vllm":
+            dtype, quantization = model.llm_engine.model_config.dtype, model.llm_engine.model_config.quantization
+        else:
+            dtype, quantization = model.model.dtype, None
+        engine_params = {
+            "backend": args.backend,
+            "dtype": str(dtype),
+            "quantization": quantization,
+            "dual_order": args.dual_order,
+        }
+        if args.verdict_logprobs:
+            cache_params = {
+                "verdict": "logprobs",
+                "rationale_tokens": args.verdict_rationale_tokens,
+                "logprobs": VERDICT_TOP_LOGPROBS,
+                "stop_token_ids": list(stop_token_ids),
+                **engine_params,
+            }
+        else:
+            cache_params = {
+                "verdict": "generate",
+                "temperature": 0,
+                "top_p": 1,
+                "max_tokens": 1024,
+                "stop_token_ids": list(stop_token_ids),
+                **engine_params,
+            }
+            if stop is not None:
+                cache_params["stop"] = stop
+        cache_keys = [
+            (system, user)
+            for systems, users in zip(dataset_prompts["system_prompt"], dataset_prompts["user_prompt"])
+            for system, user in zip(systems, users)
+        ]
+        answers = [None] * len(prompts)
+        if judgement_cache is not None:
+            answers = [judgement_cache.get(args.model, system, user, cache_params) for system, user in cache_keys]
+            logger.info(f"{sum(a is not None for a in answers)}/{len(answers)} judgements found in the cache")
+        missing = [i for i, answer in enumerate(answers) if answer is None]
 
         # generate
-        outputs = model.generate(prompts, sampling_params)
-
-        answers = [o.outputs[0].text for o in outputs]
-        winners = [process_judgement(a) for a in answers]
-
-        def process_shuffled(win, shuffle):
-            if shuffle:
-                winner_text = "B"
-                loser_text = "A"
+        if missing:
+            if args.verdict_logprobs:
+                generated = judge_verdict_logprobs([prompts[i] for i in missing])
             else:
-                winner_text = "A"
-                loser_text = "B"
-
-            if win == winner_text:
-                return 1
-            elif win == loser_text:
-                return 0
-            else:  # if "error"
-                return 0.5  # effectively a tie
-
-        results = [process_shuffled(w, s) for w, s in zip(winners, is_shuffled)]
+                generated = generate_judgements([prompts[i] for i in missing])
+            for i, answer in zip(missing, generated):
+                answers[i] = answer
+                if judgement_cache is not None:
+                    system_prompt, user_prompt = cache_keys[i]
+                    if args.verdict_logprobs:
+                        prob_a = json.loads(answer)["prob_a"]
+                        winner = "A" if prob_a > 0.5 else "B" if prob_a < 0.5 else "error"
+                    else:
+                        winner = process_judgement(answer)
+                    judgement_cache.put(args.model, system_prompt, user_prompt, cache_params, answer, winner)
+
+        if args.verdict_logprobs:
+            # continuous preference for the chosen answer, in its (possibly shuffled) position
+            probs_a = [json.loads(a)["prob_a"] for a in answers]
+            results = [1 - p if shuffle else p for p, shuffle in zip(probs_a, is_shuffled)]
+        else:
+            winners = [process_judgement(a) for a in answers]
+            results = [process_shuffled(w, s) for w, s in zip(winners, is_shuffled)]
+        if num_orders > 1:
+            # combine the verdicts of the orders of every example
+            results = [sum(results[i : i + num_orders]) / num_orders for i in range(0, len(results), num_orders)]
+
+    if judgement_cache is not None:
+        judgement_cache.close()
 
     ############################
     # Print & process results
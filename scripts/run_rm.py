@@ -22,6 +22,7 @@ import torch
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
+from datasets import Dataset
 from fastchat.conversation import get_conv_template
 from tqdm import tqdm
 from transformers import AutoTokenizer, pipeline
@@ -32,8 +33,17 @@ from rewardbench import (
     load_eval_dataset,
     save_to_hub,
 )
+from rewardbench.cache import ScoreCache
 from rewardbench.constants import EXAMPLE_COUNTS, SUBSET_MAPPING
-from rewardbench.utils import calculate_scores_per_section
+from rewardbench.models import RewardPipeline, SequenceClassifierPipeline
+from rewardbench.prefetch import BatchPrefetcher
+from rewardbench.utils import (
+    calculate_scores_per_section,
+    deduplicate_texts,
+    load_shards,
+    save_shard,
+    shard_indices,
+)
 
 # get token from HF_TOKEN env variable, but if it doesn't exist pass none
 HF_TOKEN = os.getenv("HF_TOKEN", None)
@@ -58,9 +68,26 @@ def get_args():
     parser.add_argument("--do_not_save", action="store_true", help="do not save results to hub (for debugging)")
     parser.add_argument("--batch_size", type=int, default=64, help="batch size for inference")
     parser.add_argument("--max_length", type=int, default=2048, help="Max length of RM inputs (passed to pipeline)")
+    parser.add_argument(
+        "--num_workers", type=int, default=4, help="dataloader workers tokenizing batches for custom pipelines"
+    )
+    parser.add_argument(
+        "--shared_prefix",
+        action="store_true",
+        help="encode the prompt shared by chosen and rejected once (decoder-only reward models)",
+    )
+    parser.add_argument(
+        "--score_cache", type=str, default=None, help="SQLite file caching scores across runs (e.g. scores.db)"
+    )
     parser.add_argument(
         "--pref_sets", action="store_true", help="run on common preference sets instead of our custom eval set"
     )
+    parser.add_argument("--num_shards", type=int, default=1, help="split the dataset into shards run as separate jobs")
+    parser.add_argument("--shard_index", type=int, default=0, help="index of the shard scored by this job")
+    parser.add_argument("--shard_dir", type=str, default="results/shards", help="directory of the shard outputs")
+    parser.add_argument(
+        "--merge_shards", action="store_true", help="merge the outputs of --num_shards shards and compute the results"
+    )
     parser.add_argument(
         "--debug", action="store_true", help="run on common preference sets instead of our custom eval set"
     )
@@ -71,6 +98,59 @@ def get_args():
     return args
 
 
+def save_results(args, out_dataset, model_type, chat_template, logger):
+    """
+    Print the accuracy per subset and save the grouped results and the scores of every row.
+    """
+    # get core dataset
+    results_grouped = {}
+    results_grouped["model"] = args.model
+    results_grouped["model_type"] = model_type
+    results_grouped["chat_template"] = chat_template
+
+    # print per subset and log into results_grouped file
+    present_subsets = np.unique(out_dataset["subset"])
+    for subset in present_subsets:
+        subset_dataset = out_dataset.filter(lambda example: example["subset"] == subset)
+        num_correct = sum(subset_dataset["results"])
+        num_total = len(subset_dataset["results"])
+        print(f"{subset}: {num_correct}/{num_total} ({num_correct/num_total})")
+        results_grouped[subset] = num_correct / num_total
+
+    # log leaderboard aggregated results
+    if not args.pref_sets:
+        results_leaderboard = calculate_scores_per_section(EXAMPLE_COUNTS, SUBSET_MAPPING, results_grouped)
+        print(results_leaderboard)
+
+    ############################
+    # Upload results to hub
+    ############################
+    sub_path = "eval-set/" if not args.pref_sets else "pref-sets/"
+    results_url = save_to_hub(
+        results_grouped,
+        args.model,
+        sub_path,
+        args.debug,
+        local_only=args.do_not_save,
+        save_metrics_for_beaker=not args.disable_beaker_save,
+    )
+    if not args.do_not_save:
+        logger.info(f"Uploaded reward model results to {results_url}")
+
+    # upload chosen-rejected with scores
+    # (for custom classifiers, scores_chosen is the pairwise margin and scores_rejected is 0)
+    # create new json with scores and upload
+    scores_dict = out_dataset.to_dict()
+    scores_dict["model"] = args.model
+    scores_dict["model_type"] = model_type
+    scores_dict["chat_template"] = args.chat_template
+
+    sub_path_scores = "eval-set-scores/" if not args.pref_sets else "pref-sets-scores/"
+
+    scores_url = save_to_hub(scores_dict, args.model, sub_path_scores, args.debug, local_only=args.do_not_save)
+    logger.info(f"Uploading chosen-rejected text with scores to {scores_url}")
+
+
 def main():
     args = get_args()
     ###############
@@ -121,6 +201,14 @@ def main():
     # not included in config to make user explicitly understand they are passing this
     trust_remote_code = args.trust_remote_code
 
+    sub_path = "eval-set/" if not args.pref_sets else "pref-sets/"
+    shard_dir = os.path.join(args.shard_dir, sub_path, args.model)
+    if args.merge_shards:
+        logger.info(f"*** Merging {args.num_shards} shards from {shard_dir} ***")
+        rows, metadata = load_shards(shard_dir, args.num_shards)
+        save_results(args, Dataset.from_dict(rows), metadata["model_type"], metadata["chat_template"], logger)
+        return
+
     ############################
     # Load dataset
     ############################
@@ -147,6 +235,14 @@ def main():
         subsets = subsets[:10]
         ids = ids[:10]
 
+    # shard: a deterministic, contiguous slice of the dataset scored by this job
+    if args.num_shards > 1:
+        shard = shard_indices(len(dataset), args.num_shards, args.shard_index)
+        dataset = dataset.select(shard)
+        subsets = [subsets[i] for i in shard]
+        ids = [ids[i] for i in shard]
+        logger.info(f"Running shard {args.shard_index}/{args.num_shards} with {len(shard)} examples")
+
     ############################
     # Load reward model pipeline
     ############################
@@ -170,11 +266,19 @@ def main():
         model_kwargs = {"device_map": {"": current_device}}
 
     model = model_builder(args.model, **model_kwargs, trust_remote_code=trust_remote_code)
-    reward_pipe = pipeline_builder(
-        "text-classification",
-        model=model,
-        tokenizer=tokenizer,
-    )
+    if pipeline_builder == pipeline:
+        # sequence classifiers are scored directly on tokenized, length bucketed batches instead of the HF pipeline
+        reward_pipe = SequenceClassifierPipeline(
+            "text-classification",
+            model=model,
+            tokenizer=tokenizer,
+        )
+    else:
+        reward_pipe = pipeline_builder(
+            "text-classification",
+            model=model,
+            tokenizer=tokenizer,
+        )
 
     ############################
     # Tokenization settings & dataset preparation
@@ -191,54 +295,109 @@ def main():
     if not check_tokenizer_chat_template(tokenizer):
         reward_pipe.tokenizer.add_eos_token = True
 
+    # encode the prompt once per pair and continue chosen and rejected from its KV cache
+    shared_prefix = (
+        args.shared_prefix and isinstance(reward_pipe, RewardPipeline) and reward_pipe.supports_shared_prefix
+    )
+
+    ############################
+    # Score cache, only rows with a missing score are sent to the model
+    ############################
+    score_cache = None
+    cached_chosen = [None] * len(dataset)
+    cached_rejected = [None] * len(dataset)
+    if args.score_cache is not None:
+        if model_type == "Custom Classifier":
+            logger.info("Score cache only supports models scoring single texts, scoring every pair")
+        else:
+            score_cache = ScoreCache(
+                args.score_cache,
+                args.model,
+                revision=getattr(reward_pipe.model.config, "_commit_hash", None),
+                tokenizer=tokenizer,
+                max_length=args.max_length,
+                # everything else that changes the scores, so different settings never share cached scores
+                options={
+                    "pipeline": type(reward_pipe).__name__,
+                    "shared_prefix": shared_prefix,
+                    "quantized": quantized,
+                    "dtype": reward_pipe.model.dtype,
+                    "truncation": reward_pipeline_kwargs["truncation"],
+                    "add_eos_token": getattr(reward_pipe.tokenizer, "add_eos_token", None),
+                },
+            )
+            cached_chosen = score_cache.get(dataset["text_chosen"])
+            cached_rejected = score_cache.get(dataset["text_rejected"])
+    todo = [i for i, (c, r) in enumerate(zip(cached_chosen, cached_rejected)) if c is None or r is None]
+    if score_cache is not None:
+        logger.info(f"{len(dataset) - len(todo)}/{len(dataset)} rows found in the score cache")
+    score_dataset = dataset.select(todo) if len(todo) < len(dataset) else dataset
+
     ############################
     # Run inference [1/2]" built in transformers
     ############################
-    # if using HF pipeline, can pass entire dataset and get results
+    # sequence classifiers score the entire dataset at once, returning a tensor of scores
     # first, handle custom pipelines that we must batch normally
-    if pipeline_builder == pipeline:
-        logger.info("*** Running forward pass via built in pipeline abstraction ***")
-        # this setup can be optimized slightly with one pipeline call
-        # prepare for inference
-        reward_pipe = accelerator.prepare(reward_pipe)
-
-        results_rej = reward_pipe(dataset["text_rejected"], **reward_pipeline_kwargs)
-        results_cho = reward_pipe(dataset["text_chosen"], **reward_pipeline_kwargs)
-
-        # extract scores from results which is list of dicts, e.g. [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
-        scores_chosen = [result["score"] for result in results_cho]
-        scores_rejected = [result["score"] for result in results_rej]
-
-        # pairwise comparison list comprehension
-        results = [1 if chosen > rejected else 0 for chosen, rejected in zip(scores_chosen, scores_rejected)]
+    if len(score_dataset) == 0:
+        results, scores_chosen, scores_rejected = [], [], []
+    elif pipeline_builder == pipeline:
+        logger.info("*** Running forward pass on length bucketed batches ***")
+        if shared_prefix:
+            scores_chosen, scores_rejected = reward_pipe.score_pairs(
+                score_dataset["text_chosen"], score_dataset["text_rejected"], **reward_pipeline_kwargs
+            )
+            scores_chosen, scores_rejected = scores_chosen.cpu().numpy(), scores_rejected.cpu().numpy()
+        else:
+            # score chosen and rejected texts in one pass, once per distinct text (many repeat across rows/subsets)
+            texts = score_dataset["text_chosen"] + score_dataset["text_rejected"]
+            unique_texts, inverse = deduplicate_texts(texts)
+            logger.info(f"Scoring {len(unique_texts)} unique texts out of {len(texts)}")
+            scores = reward_pipe(unique_texts, **reward_pipeline_kwargs).cpu().numpy()[inverse]
+            scores_chosen, scores_rejected = scores[: len(score_dataset)], scores[len(score_dataset) :]
+
+        # pairwise comparison, vectorized
+        results = (scores_chosen > scores_rejected).astype(int).tolist()
+        scores_chosen = scores_chosen.tolist()
+        scores_rejected = scores_rejected.tolist()
 
     ############################
     # Run inference [2/2] custom pipelines
     ############################
     else:
         logger.info("*** Running dataloader to collect results ***")
-        # TODO make more custom pipelines work with pre-tokenized data
         from torch.utils.data.dataloader import default_collate
 
-        # for PairRM, hmm, will move all of this later
         def custom_collate_fn(batch):
-            # check if ['text_chosen'] is in first batch element
-            # Check if the first element of the batch is a dictionary
+            # pipelines with a `preprocess` step are tokenized here, in the dataloader workers,
+            # so tokenization of the next batches overlaps with the forward passes
+            if isinstance(reward_pipe, RewardPipeline):
+                text_chosen = [b["text_chosen"] for b in batch]
+                text_rejected = [b["text_rejected"] for b in batch]
+                if model_type == "Custom Classifier":
+                    return reward_pipe.preprocess(text_chosen, text_rejected, **reward_pipeline_kwargs)
+                return {
+                    "text_chosen": reward_pipe.preprocess(text_chosen, **reward_pipeline_kwargs),
+                    "text_rejected": reward_pipe.preprocess(text_rejected, **reward_pipeline_kwargs),
+                }
+            # for PairRM, pass the conversations (list of dicts) as-is
             if isinstance(batch[0]["text_chosen"][0], dict):
                 return batch  # Return the batch as-is if it's a list of dicts
             else:
                 return default_collate(batch)  # Use the default collate behavior otherwise
 
         dataloader = torch.utils.data.DataLoader(
-            dataset,
+            score_dataset,
             batch_size=BATCH_SIZE,
             collate_fn=custom_collate_fn,  # if not args.pref_sets else None,
             shuffle=False,
             drop_last=False,
+            num_workers=args.num_workers,
         )
 
         dataloader, model = accelerator.prepare(dataloader, reward_pipe.model)
         reward_pipe.model = model
+        # fetch the next batches in the background while the current one is scored
+        dataloader = BatchPrefetcher(dataloader)
 
         results = []
         scores_chosen = []
@@ -247,15 +406,25 @@ def main():
             logger.info(f"RM inference step {step}/{len(dataloader)}")
 
             if model_type == "Custom Classifier":
-                text_rejected = [b["text_rejected"] for b in batch]
-                text_chosen = [b["text_chosen"] for b in batch]
-                results_sub = reward_pipe(text_chosen, text_rejected, **reward_pipeline_kwargs)
-                [results.append(1) if result else results.append(0) for result in results_sub.cpu().numpy().tolist()]
-                scores_chosen.extend([None] * len(results_sub))
-                scores_rejected.extend([None] * len(results_sub))
+                # pairwise models return the margin of chosen over rejected, stored as the chosen score
+                if isinstance(reward_pipe, RewardPipeline):
+                    # pre-tokenized pairs from the collate function
+                    margins = reward_pipe(batch, output_logits=True, **reward_pipeline_kwargs)
+                else:
+                    text_rejected = [b["text_rejected"] for b in batch]
+                    text_chosen = [b["text_chosen"] for b in batch]
+                    margins = reward_pipe(text_chosen, text_rejected, output_logits=True, **reward_pipeline_kwargs)
+                [results.append(1) if margin > 0 else results.append(0) for margin in margins]
+                scores_chosen.extend(margins)
+                scores_rejected.extend([0.0] * len(margins))
             else:
-                rewards_chosen = reward_pipe(batch["text_chosen"], **reward_pipeline_kwargs)
-                rewards_rejected = reward_pipe(batch["text_rejected"], **reward_pipeline_kwargs)
+                if shared_prefix:
+                    rewards_chosen, rewards_rejected = reward_pipe.score_pairs(
+                        batch["text_chosen"], batch["text_rejected"], **reward_pipeline_kwargs
+                    )
+                else:
+                    rewards_chosen = reward_pipe(batch["text_chosen"], **reward_pipeline_kwargs)
+                    rewards_rejected = reward_pipe(batch["text_rejected"], **reward_pipeline_kwargs)
 
                 # for each item in batch, record 1 if chosen > rejected
                 # extra score from dict within batched results (e.g. logits)
@@ -276,6 +445,17 @@ def main():
                 scores_chosen.extend(score_chosen_batch)
                 scores_rejected.extend(score_rejected_batch)
 
+    if score_cache is not None:
+        score_cache.put(
+            score_dataset["text_chosen"] + score_dataset["text_rejected"], list(scores_chosen) + list(scores_rejected)
+        )
+        score_cache.close()
+        # merge new and cached scores in dataset order
+        for i, chosen, rejected in zip(todo, scores_chosen, scores_rejected):
+            cached_chosen[i], cached_rejected[i] = chosen, rejected
+        scores_chosen, scores_rejected = cached_chosen, cached_rejected
+        results = [1 if chosen > rejected else 0 for chosen, rejected in zip(scores_chosen, scores_rejected)]
+
     ############################
     # Print & process results
     ############################
@@ -290,57 +470,15 @@ def main():
     out_dataset = out_dataset.add_column("scores_chosen", scores_chosen)
     out_dataset = out_dataset.add_column("scores_rejected", scores_rejected)
 
-    # get core dataset
-    results_grouped = {}
-    results_grouped["model"] = args.model
-    results_grouped["model_type"] = model_type
-    results_grouped["chat_template"] = (
-        args.chat_template if not check_tokenizer_chat_template(tokenizer) else "tokenizer"
-    )
+    chat_template = args.chat_template if not check_tokenizer_chat_template(tokenizer) else "tokenizer"
+    if args.num_shards > 1:
+        # save the scored rows of this shard, results are computed once all shards are merged
+        metadata = {"model": args.model, "model_type": model_type, "chat_template": chat_template}
+        path = save_shard(out_dataset.to_dict(), shard, shard_dir, args.shard_index, args.num_shards, metadata)
+        logger.info(f"Saved shard {args.shard_index}/{args.num_shards} to {path}")
+        return
 
-    # print per subset and log into results_grouped file
-    present_subsets = np.unique(subsets)
-    for subset in present_subsets:
-        subset_dataset = out_dataset.filter(lambda example: example["subset"] == subset)
-        num_correct = sum(subset_dataset["results"])
-        num_total = len(subset_dataset["results"])
-        print(f"{subset}: {num_correct}/{num_total} ({num_correct/num_total})")
-        results_grouped[subset] = num_correct / num_total
-
-    # log leaderboard aggregated results
-    if not args.pref_sets:
-        results_leaderboard = calculate_scores_per_section(EXAMPLE_COUNTS, SUBSET_MAPPING, results_grouped)
-        print(results_leaderboard)
-
-    ############################
-    # Upload results to hub
-    ############################
-    sub_path = "eval-set/" if not args.pref_sets else "pref-sets/"
-    results_url = save_to_hub(
-        results_grouped,
-        args.model,
-        sub_path,
-        args.debug,
-        local_only=args.do_not_save,
-        save_metrics_for_beaker=not args.disable_beaker_save,
-    )
-    if not args.do_not_save:
-        logger.info(f"Uploaded reward model results to {results_url}")
-
-    # upload chosen-rejected with scores
-    if not model_type == "Custom Classifier":  # custom classifiers do not return scores
-        # create new json with scores and upload
-        scores_dict = out_dataset.to_dict()
-        scores_dict["model"] = args.model
-        scores_dict["model_type"] = model_type
-        scores_dict["chat_template"] = args.chat_template
-
-        sub_path_scores = "eval-set-scores/" if not args.pref_sets else "pref-sets-scores/"
-
-        scores_url = save_to_hub(scores_dict, args.model, sub_path_scores, args.debug, local_only=args.do_not_save)
-        logger.info(f"Uploading chosen-rejected text with scores to {scores_url}")
-    else:
-        logger.info("Not uploading chosen-rejected text with scores due to model compatibility")
+    save_results(args, out_dataset, model_type, chat_template, logger)
 
 
 if __name__ == "__main__":
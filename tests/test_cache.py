@@ -0,0 +1,71 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+import unittest
+
+from rewardbench.cache import JudgementCache, ScoreCache
+
+
+class ScoreCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "scores.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_persists_across_runs(self):
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=2048)
+        cache.put(["a", "b"], [0.5, -1.25])
+        cache.close()
+
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=2048)
+        assert cache.get(["b", "c", "a", "b"]) == [-1.25, None, 0.5, -1.25]
+        cache.close()
+
+    def test_keyed_by_model_settings(self):
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=2048)
+        cache.put(["a"], [0.5])
+        cache.close()
+
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=4096)
+        assert cache.get(["a"]) == [None]
+        cache.close()
+
+    def test_keyed_by_scoring_options(self):
+        options = {"pipeline": "SequenceClassifierPipeline", "shared_prefix": False, "dtype": "torch.bfloat16"}
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=2048, options=options)
+        cache.put(["a"], [0.5])
+        cache.close()
+
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=2048, options=dict(options))
+        assert cache.get(["a"]) == [0.5]
+        cache.close()
+        # scores of the shared prefix path are not served to the normal forward and vice versa
+        cache = ScoreCache(self.path, "fake/fake_model", max_length=2048, options={**options, "shared_prefix": True})
+        assert cache.get(["a"]) == [None]
+        cache.close()
+
+
+class JudgementCacheTest(unittest.TestCase):
+    def test_keyed_by_prompt_and_sampling_params(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = JudgementCache(os.path.join(tmp_dir, "judge.db"))
+            params = {"temperature": 0, "max_tokens": 2048}
+            cache.put("gpt-4", "system", "user", params, "A is better [[A]]", "A")
+            assert cache.get("gpt-4", "system", "user", params) == "A is better [[A]]"
+            assert cache.get("gpt-4", "system", "user", {"temperature": 1, "max_tokens": 2048}) is None
+            assert cache.get("gpt-4", "system", "other user", params) is None
+            cache.close()
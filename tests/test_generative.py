@@ -0,0 +1,195 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import json
+import math
+import os
+import tempfile
+import time
+import unittest
+
+from rewardbench.generative import (
+    API_ERROR_OUTPUT,
+    API_MAX_RETRY_SLEEP,
+    AIMDLimiter,
+    JudgementLog,
+    TokenBucket,
+    batch_custom_id,
+    format_batch_request,
+    judgement_log_path,
+    load_batch_results,
+    parse_batch_custom_id,
+    process_verdict_logprobs,
+    retry_sleep_time,
+    truncate_at_stop,
+)
+
+
+class RateLimitTest(unittest.TestCase):
+    def test_token_bucket_paces_requests(self):
+        async def acquire_all():
+            bucket = TokenBucket(rate_per_minute=600)  # 10 per second, 600 available at once
+            start = time.monotonic()
+            for _ in range(600 + 5):
+                await bucket.acquire(1)
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(acquire_all())
+        assert 0.4 < elapsed < 2.0
+
+    def test_aimd_limiter(self):
+        async def succeed(limiter, times):
+            for _ in range(times):
+                await limiter.on_success()
+
+        limiter = AIMDLimiter(max_concurrency=8, initial_concurrency=4)
+        limiter.on_rate_limit()
+        assert limiter.limit == 2
+        asyncio.run(succeed(limiter, 100))
+        assert limiter.limit == 8
+
+    def test_aimd_increase_wakes_waiting_tasks(self):
+        async def run():
+            limiter = AIMDLimiter(max_concurrency=2, initial_concurrency=1)
+            await limiter.__aenter__()  # the only slot stays taken
+            waiting = asyncio.create_task(limiter.__aenter__())
+            await asyncio.sleep(0.01)
+            assert not waiting.done()
+            # the second slot is granted without the first request finishing
+            await limiter.on_success()
+            await asyncio.wait_for(waiting, timeout=1)
+            return limiter.in_flight
+
+        assert asyncio.run(run()) == 2
+
+    def test_retry_sleep_time(self):
+        for attempt in range(10):
+            assert 0 <= retry_sleep_time(attempt) <= API_MAX_RETRY_SLEEP
+        assert retry_sleep_time(0, retry_after="30") >= 30
+
+
+class JudgementLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "logs", "judge.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resume(self):
+        log = JudgementLog(self.path)
+        log.write({"index": 3, "is_shuffled": True, "judgement": "[[B]]", "result": 1})
+        log.write({"index": 0, "is_shuffled": False, "judgement": API_ERROR_OUTPUT, "result": 0.5})
+        log.close()
+        with open(self.path, "a") as f:
+            f.write('{"index": 1, "is_shu')  # crashed while writing
+
+        log = JudgementLog(self.path, resume=True)
+        # failed API calls and the cut off record are judged again
+        assert list(log.records) == [3]
+        assert log.records[3]["is_shuffled"]
+        log.write({"index": 1, "is_shuffled": False, "judgement": "[[A]]", "result": 1})
+        log.close()
+
+        log = JudgementLog(self.path, resume=True)
+        assert sorted(log.records) == [1, 3]
+        log.close()
+
+    def test_no_resume_keeps_judgements(self):
+        log = JudgementLog(self.path)
+        log.write({"index": 0, "judgement": "[[A]]", "result": 1})
+        log.close()
+        with self.assertRaises(FileExistsError):
+            JudgementLog(self.path)
+        with open(self.path) as f:
+            assert [json.loads(line)["index"] for line in f] == [0]
+
+        # only replaced on request
+        JudgementLog(self.path, overwrite=True).close()
+        with open(self.path) as f:
+            assert [json.loads(line) for line in f] == []
+        # an empty log can be started again
+        JudgementLog(self.path).close()
+
+    def test_default_path_per_run(self):
+        def path(**kwargs):
+            return judgement_log_path("org/judge", log_dir=self.tmp_dir.name, **kwargs)
+
+        # debug and full runs, seeds and servers do not share the default log
+        paths = {
+            path(),
+            path(debug=True),
+            path(seed=0),
+            path(pref_sets=True),
+            path(base_url="http://localhost:8000/v1"),
+        }
+        assert len(paths) == 5
+        assert path(base_url="http://localhost:8000/v1", debug=True) == os.path.join(
+            self.tmp_dir.name, "eval-set", "org", "judge-seed42-localhost-8000-debug.jsonl"
+        )
+
+        # a re-run of the same configuration replaces its default log, as run_generative.py opens it
+        for _ in range(2):
+            log = JudgementLog(path(), overwrite=True)
+            log.write({"index": 0, "judgement": "[[A]]", "result": 1})
+            log.close()
+        with open(path()) as f:
+            assert [json.loads(line)["index"] for line in f] == [0]
+
+
+class VerdictLogprobsTest(unittest.TestCase):
+    def test_renormalized_over_verdict_tokens(self):
+        token_logprobs = [("A", math.log(0.6)), (" B", math.log(0.2)), ("B", math.log(0.1)), ("]]", math.log(0.1))]
+        assert abs(process_verdict_logprobs(token_logprobs) - 2 / 3) < 1e-6
+
+    def test_no_verdict_token(self):
+        assert process_verdict_logprobs([("The", -0.1)]) == 0.5
+        assert process_verdict_logprobs([("B", -3.0)]) == 0.0
+
+    def test_truncate_at_stop(self):
+        assert truncate_at_stop("A is better. [[A]] Also [[B]]", ["]]"]) == "A is better. [[A]]"
+        assert truncate_at_stop("Both are good. [[", ["]]", "[["]) == "Both are good. [["
+        assert truncate_at_stop("no verdict", ["]]"]) == "no verdict"
+        assert truncate_at_stop("no stop strings") == "no stop strings"
+
+
+class BatchFileTest(unittest.TestCase):
+    fixtures = os.path.join(os.path.dirname(__file__), "fixtures")
+
+    def test_custom_id_round_trip(self):
+        for index in (0, 17):
+            for is_shuffled in (False, True):
+                assert parse_batch_custom_id(batch_custom_id(index, is_shuffled)) == (index, is_shuffled)
+
+    def test_format_requests(self):
+        request = format_batch_request("rewardbench-0-AB", "gpt-4-turbo", "system", "user")
+        assert request["url"] == "/v1/chat/completions"
+        assert [m["role"] for m in request["body"]["messages"]] == ["system", "user"]
+        request = format_batch_request("rewardbench-0-AB", "claude-3-haiku-20240307", "system", "user")
+        assert request["params"]["system"] == "system"
+        assert request["params"]["messages"] == [{"role": "user", "content": "user"}]
+        with self.assertRaises(ValueError):
+            format_batch_request("rewardbench-0-AB", "not-a-judge", "system", "user")
+
+    def test_load_openai_results(self):
+        results = load_batch_results(os.path.join(self.fixtures, "batch_results_openai.jsonl"))
+        assert sorted(results) == [0, 1, 2]
+        assert results[0] == (False, "Assistant A answers the question directly.\n\n[[A]]")
+        assert results[1][0] and results[1][1].endswith("[[B]]")
+        assert results[2] == (False, API_ERROR_OUTPUT)
+
+    def test_load_anthropic_results(self):
+        results = load_batch_results(os.path.join(self.fixtures, "batch_results_anthropic.jsonl"))
+        assert results[3] == (True, "Assistant A is wrong. [[B]]")
+        assert results[4] == (False, API_ERROR_OUTPUT)
@@ -0,0 +1,128 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import json
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from rewardbench import generative
+from rewardbench.generative import (
+    AsyncJudgeClient,
+    run_judge_pair,
+    run_judge_pair_async,
+)
+from rewardbench.mock_judge import MockJudgeServer
+
+
+def post(url, body):
+    request = urllib.request.Request(
+        url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+class MockJudgeServerTest(unittest.TestCase):
+    messages = [{"role": "user", "content": "Which answer is better?"}]
+
+    def test_openai_and_anthropic_formats(self):
+        with MockJudgeServer(latency=0.0) as server:
+            openai_response = post(
+                server.url + "/v1/chat/completions",
+                {"model": "gpt-4-turbo", "messages": [{"role": "system", "content": "judge"}] + self.messages},
+            )
+            anthropic_response = post(
+                server.url + "/v1/messages",
+                {"model": "claude-3-haiku-20240307", "system": "judge", "messages": self.messages},
+            )
+            assert server.num_requests == 2
+        openai_text = openai_response["choices"][0]["message"]["content"]
+        anthropic_text = anthropic_response["content"][0]["text"]
+        for text in (openai_text, anthropic_text):
+            assert "[[A]]" in text or "[[B]]" in text
+
+        # the answer only depends on the messages
+        with MockJudgeServer(latency=0.0) as server:
+            body = {"model": "claude-3-haiku-20240307", "system": "judge", "messages": self.messages}
+            assert post(server.url + "/v1/messages", body)["content"][0]["text"] == anthropic_text
+
+    def test_rate_limits(self):
+        with MockJudgeServer(latency=0.0, rate_limit_prob=1.0, retry_after=3) as server:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                post(server.url + "/v1/chat/completions", {"model": "gpt-4-turbo", "messages": self.messages})
+            assert server.num_rate_limited == 1
+        assert context.exception.code == 429
+        assert context.exception.headers["retry-after"] == "3"
+
+
+class JudgeClientAgainstMockTest(unittest.TestCase):
+    def test_every_prompt_judged_despite_rate_limits(self):
+        async def judge_all(base_url):
+            client = AsyncJudgeClient("gpt-4-turbo", max_concurrency=8, base_url=base_url, api_key="mock")
+            try:
+                judgements = await asyncio.gather(
+                    *(
+                        run_judge_pair_async(
+                            f"Question {i}",
+                            [{"role": "user", "content": f"Question {i}"}, {"role": "assistant", "content": "yes"}],
+                            [{"role": "user", "content": f"Question {i}"}, {"role": "assistant", "content": "no"}],
+                            client,
+                        )
+                        for i in range(20)
+                    )
+                )
+            finally:
+                await client.close()
+            return judgements, client.num_rate_limits
+
+        # short backoff, the server's retry-after still applies
+        with mock.patch.object(generative, "API_RETRY_SLEEP", 0.01):
+            with MockJudgeServer(latency=0.0, rate_limit_prob=0.3, retry_after=0.01, seed=0) as server:
+                judgements, num_rate_limits = asyncio.run(judge_all(server.url + "/v1"))
+                num_rate_limited = server.num_rate_limited
+
+        # every prompt got a verdict, 429s were retried (through the OpenAI client on the mock's base url)
+        assert len(judgements) == 20
+        assert all(winner in ("A", "B") for winner, _, _ in judgements)
+        assert num_rate_limited > 0
+        assert num_rate_limits == num_rate_limited
+
+    def test_served_judge_budget_matches_sync_path(self):
+        model = "meta-llama/Meta-Llama-3-8B-Instruct"
+        question = "Question 0"
+        answer_a = [{"role": "user", "content": question}, {"role": "assistant", "content": "yes"}]
+        answer_b = [{"role": "user", "content": question}, {"role": "assistant", "content": "no"}]
+
+        async def judge_async(base_url):
+            client = AsyncJudgeClient(model, base_url=base_url, api_key="mock")
+            try:
+                with mock.patch.object(client, "judge", wraps=client.judge) as judge:
+                    await run_judge_pair_async(question, answer_a, answer_b, client)
+            finally:
+                await client.close()
+            return judge.call_args.kwargs["max_tokens"]
+
+        with MockJudgeServer(latency=0.0) as server:
+            with mock.patch.object(
+                generative, "chat_completion_openai", wraps=generative.chat_completion_openai
+            ) as completion:
+                run_judge_pair(
+                    question, answer_a, answer_b, model, api_dict={"api_base": server.url + "/v1", "api_key": "mock"}
+                )
+            async_max_tokens = asyncio.run(judge_async(server.url + "/v1"))
+
+        # a model served on --base_url truncates its judgement at the same length in both paths
+        assert async_max_tokens == completion.call_args.kwargs["max_tokens"] == 2048
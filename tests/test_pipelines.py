@@ -0,0 +1,386 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import torch
+from tokenizers import Tokenizer, decoders, pre_tokenizers, processors
+from tokenizers.models import WordLevel
+from transformers import (
+    DebertaV2Config,
+    DebertaV2TokenizerFast,
+    LlamaConfig,
+    LlamaForSequenceClassification,
+    PreTrainedTokenizerFast,
+    T5Config,
+    T5ForConditionalGeneration,
+)
+
+from rewardbench.models import SequenceClassifierPipeline
+from rewardbench.models.betterpairrm import (
+    BETTER_PAIRRM_JINJA_TEMPLATE,
+    BetterPairRMPipeline,
+)
+from rewardbench.models.betterpairrm import (
+    tokenize_conv_pair as better_tokenize_conv_pair,
+)
+from rewardbench.models.pairrm import (
+    DebertaV2PairRM,
+    PairRMPipeline,
+    tokenize_conv_pair,
+    truncate_ids,
+)
+from rewardbench.models.shp import SHPPipeline
+
+PAIRRM_PREFIXES = ["<|source|>", "<|candidate1|>", "<|candidate2|>"]
+
+
+def deberta_tokenizer(words):
+    # word level stand-in for the DeBERTa tokenizer of the PairRM models: [CLS] ... [SEP] around every text
+    vocab = {token: i for i, token in enumerate(["[PAD]", "[CLS]", "[SEP]", "[UNK]"] + list(dict.fromkeys(words)))}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])]
+    )
+    tokenizer.decoder = decoders.WordPiece()
+    return DebertaV2TokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="[CLS]",
+        eos_token="[SEP]",
+        cls_token="[CLS]",
+        sep_token="[SEP]",
+        pad_token="[PAD]",
+        unk_token="[UNK]",
+        additional_special_tokens=PAIRRM_PREFIXES,
+    )
+
+
+def tiny_pairrm(tokenizer):
+    prefix_ids = tokenizer.convert_tokens_to_ids(PAIRRM_PREFIXES)
+    config = DebertaV2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        max_position_embeddings=128,
+        initializer_range=0.5,  # scores well above the tolerance
+        pad_token_id=tokenizer.pad_token_id,
+        n_tasks=1,
+        drop_out=0.1,
+        sep_token_id=tokenizer.sep_token_id,
+        source_prefix_id=prefix_ids[0],
+        cand_prefix_id=prefix_ids[1],
+        cand1_prefix_id=prefix_ids[1],
+        cand2_prefix_id=prefix_ids[2],
+    )
+    return DebertaV2PairRM(config).eval()
+
+
+def unpadded_ids(encodings):
+    return [ids[mask.bool()].tolist() for ids, mask in zip(encodings["input_ids"], encodings["attention_mask"])]
+
+
+def conversation(*turns):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": turn} for i, turn in enumerate(turns)]
+
+
+class SharedPrefixScoringTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        vocab = {"<unk>": 0, "<s>": 1, "</s>": 2, **{f"t{i}": i for i in range(3, 32)}}
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=Tokenizer(WordLevel(vocab, unk_token="<unk>")),
+            bos_token="<s>",
+            eos_token="</s>",
+            pad_token="</s>",  # as set by run_rm.py for tokenizers without a pad token
+        )
+        config = LlamaConfig(
+            vocab_size=len(vocab),
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            num_key_value_heads=2,
+            num_labels=1,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+        model = LlamaForSequenceClassification(config).eval()
+        self.pipe = SequenceClassifierPipeline("text-classification", model, tokenizer)
+        self.eos = tokenizer.eos_token_id
+
+    def test_score_pairs_matches_batched_score(self):
+        # multi-turn prompt with an eos after the first turn, and a response with an eos in the middle
+        prompt = [1, 5, 6, 7, self.eos, 8, 9]
+        chosen = [prompt + [10, 11, 12], prompt + [20, self.eos, 21, 22], [1, 5, 6, 13, 14, 15, 16]]
+        rejected = [prompt + [13, 14], prompt + [23, 24, 25, 26, 27], [1, 5, 6, 17]]
+
+        scores_chosen, scores_rejected = self.pipe.score_pairs(
+            {"input_ids": chosen}, {"input_ids": rejected}, batch_size=2
+        )
+        expected = self.pipe({"input_ids": chosen + rejected}, batch_size=4)
+
+        assert torch.allclose(scores_chosen, expected[: len(chosen)], atol=1e-5)
+        assert torch.allclose(scores_rejected, expected[len(chosen) :], atol=1e-5)
+
+    def test_pool_index_before_first_pad(self):
+        assert self.pipe._pool_index([1, 5, 6, 7]) == 3
+        assert self.pipe._pool_index([1, 5, self.eos, 8, 9]) == 1
+        assert self.pipe._pool_index([1, 5, 6, self.eos]) == 2
+
+
+class PairRMTokenizationTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tokenizer = deberta_tokenizer("USER: Assistant: hello how are you fine thanks not bad at all".split())
+        long_answer = " ".join(["fine", "thanks", "not", "bad"] * 10)
+        self.convs_a = [
+            conversation("hello how are you", "fine thanks"),
+            conversation("hello", long_answer),
+            conversation("hello", "fine", "how are you", "not bad at all"),
+        ]
+        self.convs_b = [
+            conversation("hello how are you", "not bad"),
+            conversation("hello", "thanks"),
+            conversation("hello", "thanks", "how are you", long_answer),
+        ]
+
+    def reference_ids(self, convs_a, convs_b, source_max_length=1224, candidate_max_length=412):
+        # string level tokenization of the original PairRM code, one encode per text with the tokenizer's truncation
+        instruction = (
+            "Finish the following coversation in each i-th turn by filling in <Response i> with your response."
+        )
+        max_length = source_max_length + 2 * candidate_max_length
+        ids = []
+        for conv_a, conv_b in zip(convs_a, convs_b):
+            source = instruction + "\n".join(
+                [
+                    "USER: " + conv_a[i]["content"] + f"\nAssistant: <Response {i//2+1}>"
+                    for i in range(0, len(conv_a), 2)
+                ]
+            )
+            candidate1, candidate2 = [
+                "\n".join([f"<Response {i//2+1}>: " + c[i]["content"] for i in range(1, len(c), 2)])
+                for c in (conv_a, conv_b)
+            ]
+            source_ids = self.tokenizer.encode("<|source|>" + source, max_length=source_max_length, truncation=True)
+            candidate_length = (max_length - len(source_ids)) // 2
+            candidate1_ids = self.tokenizer.encode(
+                "<|candidate1|>" + candidate1, max_length=candidate_length, truncation=True
+            )
+            candidate2_ids = self.tokenizer.encode(
+                "<|candidate2|>" + candidate2, max_length=candidate_length, truncation=True
+            )
+            ids.append(source_ids + candidate1_ids + candidate2_ids)
+        return ids
+
+    def test_tokenize_conv_pair_matches_string_tokenization(self):
+        # small lengths, so the sources and the long answers are truncated
+        for source_max_length, candidate_max_length in [(1224, 412), (12, 10), (6, 4)]:
+            encodings = tokenize_conv_pair(
+                self.tokenizer,
+                self.convs_a,
+                self.convs_b,
+                source_max_length=source_max_length,
+                candidate_max_length=candidate_max_length,
+            )
+            expected = self.reference_ids(self.convs_a, self.convs_b, source_max_length, candidate_max_length)
+            assert unpadded_ids(encodings) == expected
+
+    def test_pipeline_matches_separate_orderings(self):
+        model = tiny_pairrm(self.tokenizer)
+        pipe = PairRMPipeline("text-classification", model, self.tokenizer)
+        logits = pipe(self.convs_a, self.convs_b, output_logits=True, batch_size=2)
+
+        # the original pipeline, (A, B) and (B, A) in separate forward passes padded to the maximum length
+        def forward(convs_a, convs_b):
+            inputs = self.tokenizer.pad(
+                {"input_ids": self.reference_ids(convs_a, convs_b)},
+                return_tensors="pt",
+                padding="max_length",
+                max_length=1224 + 2 * 412,
+            )
+            return model(**inputs).logits
+
+        expected = forward(self.convs_a, self.convs_b) - forward(self.convs_b, self.convs_a)
+        assert torch.allclose(torch.tensor(logits), expected, atol=1e-5)
+
+    def test_truncate_ids(self):
+        ids = self.tokenizer.encode("hello how are you", add_special_tokens=False)
+        assert truncate_ids(self.tokenizer, ids, 4) == self.tokenizer.encode(
+            "hello how are you", max_length=4, truncation=True
+        )
+        assert truncate_ids(self.tokenizer, ids, 4, truncation_side="left") == [1] + ids[-2:] + [2]
+
+    def test_truncate_ids_requires_special_tokens_method(self):
+        # a generic fast tokenizer only adds [CLS] / [SEP] in its post-processor
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=self.tokenizer.backend_tokenizer, pad_token="[PAD]")
+        assert tokenizer.num_special_tokens_to_add() == 2
+        with self.assertRaises(ValueError):
+            truncate_ids(tokenizer, [5, 6, 7], 4)
+
+
+class BetterPairRMTokenizationTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        words = "USER: ASSISTANT: hello how are you fine thanks not bad at all".split()
+        self.tokenizer = deberta_tokenizer(words)
+        # longer than the 2030 source and 670 candidate tokens kept by tokenize_conv_pair
+        long_question = " ".join(words[2:6] * 600)
+        long_answer = " ".join(words[6:] * 200)
+        self.convs_a = [
+            conversation("hello how are you", "fine thanks"),
+            conversation(long_question, long_answer),
+            conversation("hello", "fine", "how are you", "not bad at all"),
+        ]
+        self.convs_b = [
+            conversation("hello how are you", "not bad"),
+            conversation(long_question, "thanks"),
+            conversation("hello", "thanks", "how are you", long_answer),
+        ]
+
+    def reference_ids(self, convs_a, convs_b, source_max_length=2030, candidate_max_length=670):
+        # string level tokenization of the original Better-PairRM code: texts are truncated by an encode / decode
+        # round trip, then encoded again with the tokenizer's truncation side set for every text
+        tokenizer = self.tokenizer
+
+        def truncate_texts(text, max_length, truncate_side):
+            tokenizer.truncation_side = truncate_side
+            tokens = tokenizer.encode(text, add_special_tokens=False, max_length=max_length, truncation=True)
+            return tokenizer.decode(tokens, skip_special_tokens=True)
+
+        source_tokens = tokenizer.encode("<|source|>")
+        max_length = source_max_length + 2 * candidate_max_length
+        ids = []
+        for conv_a, conv_b in zip(convs_a, convs_b):
+            source = BETTER_PAIRRM_JINJA_TEMPLATE.render(messages=conv_a[:-1], add_generation_prompt=True)
+            source = truncate_texts(source, 2030, "left")
+            candidate1 = truncate_texts(conv_a[-1]["content"], 670, "right")
+            candidate2 = truncate_texts(conv_b[-1]["content"], 670, "right")
+
+            tokenizer.truncation_side = "left"
+            source_ids = source_tokens + tokenizer.encode(
+                source, max_length=source_max_length - len(source_tokens), truncation=True
+            )
+            tokenizer.truncation_side = "right"
+            candidate_length = (max_length - len(source_ids)) // 2
+            candidate1_ids = tokenizer.encode(
+                "<|candidate1|>" + candidate1, max_length=candidate_length, truncation=True
+            )
+            candidate2_ids = tokenizer.encode(
+                "<|candidate2|>" + candidate2, max_length=candidate_length, truncation=True
+            )
+            ids.append(source_ids + candidate1_ids + candidate2_ids)
+        tokenizer.truncation_side = "right"
+        return ids
+
+    def test_tokenize_conv_pair_matches_string_tokenization(self):
+        for source_max_length, candidate_max_length in [(2030, 670), (12, 10), (6, 4)]:
+            encodings = better_tokenize_conv_pair(
+                self.tokenizer,
+                self.convs_a,
+                self.convs_b,
+                source_max_length=source_max_length,
+                candidate_max_length=candidate_max_length,
+            )
+            expected = self.reference_ids(self.convs_a, self.convs_b, source_max_length, candidate_max_length)
+            assert unpadded_ids(encodings) == expected
+
+    def test_pipeline_matches_separate_orderings(self):
+        model = tiny_pairrm(self.tokenizer)
+        pipe = BetterPairRMPipeline("text-classification", model, self.tokenizer)
+        # short conversations, within the position embeddings of the tiny model
+        convs_a = [self.convs_a[0], self.convs_a[2]]
+        convs_b = [self.convs_b[0], conversation("hello", "thanks", "how are you", "fine")]
+        logits = pipe(convs_a, convs_b, output_logits=True, batch_size=1)
+
+        # the original pipeline, (A, B) and (B, A) in separate forward passes padded to the maximum length
+        def forward(convs_a, convs_b):
+            inputs = self.tokenizer.pad(
+                {"input_ids": self.reference_ids(convs_a, convs_b)},
+                return_tensors="pt",
+                padding="max_length",
+                max_length=2030 + 2 * 670,
+            )
+            return model(**inputs).logits
+
+        expected = forward(convs_a, convs_b) - forward(convs_b, convs_a)
+        assert torch.allclose(torch.tensor(logits), expected, atol=1e-5)
+
+
+class SHPScoringTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        words = "POST: RESPONSE A: B: Which response is better? A B hello how are you fine thanks not bad".split()
+        vocab = {token: i for i, token in enumerate(["<pad>", "</s>", "<unk>"] + list(dict.fromkeys(words)))}
+        tokenizer = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+        tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        tokenizer.post_processor = processors.TemplateProcessing(single="$A </s>", special_tokens=[("</s>", 1)])
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer,
+            pad_token="<pad>",
+            eos_token="</s>",
+            unk_token="<unk>",
+            model_input_names=["input_ids", "attention_mask"],  # as the T5 tokenizers
+        )
+        config = T5Config(
+            vocab_size=len(vocab),
+            d_model=16,
+            d_ff=32,
+            d_kv=8,
+            num_layers=2,
+            num_heads=2,
+            decoder_start_token_id=0,
+            pad_token_id=0,
+            eos_token_id=1,
+            tie_word_embeddings=False,
+        )
+        model = T5ForConditionalGeneration(config).eval()
+        self.pipe = SHPPipeline("text2text-generation", model, tokenizer)
+        # like the real model, answer "A" or "B": every other token gets a zero logit, one of A / B is above it
+        with torch.no_grad():
+            head = model.lm_head.weight
+            head[self.pipe.token_id_B] = -head[self.pipe.token_id_A]
+            head[[i for i in range(len(vocab)) if i not in (self.pipe.token_id_A, self.pipe.token_id_B)]] = 0
+
+    def test_scores_match_generated_verdicts(self):
+        convs_a = [conversation("hello how are you", "fine thanks"), conversation("hello", "not bad")]
+        convs_b = [conversation("hello how are you", "bad"), conversation("hello", "thanks fine thanks fine")]
+        encodings = self.pipe.preprocess(convs_a, convs_b)
+        tokenizer, model = self.pipe.tokenizer, self.pipe.model
+        texts = [tokenizer.decode(ids, skip_special_tokens=True) for ids in encodings["input_ids"]]
+
+        verdicts = []
+        for _ in range(2):
+            scores = self.pipe.score(encodings, batch_size=4)
+
+            # the original pipeline, one generated token per ordering, read as a verdict for "A"
+            inputs = tokenizer(texts, padding=True, return_tensors="pt")
+            outputs = model.generate(**inputs, max_new_tokens=1, output_scores=True, return_dict_in_generate=True)
+            generated = tokenizer.batch_decode(outputs.sequences, skip_special_tokens=True)
+            first_step = outputs.scores[0]
+
+            assert torch.allclose(
+                scores, first_step[:, self.pipe.token_id_A] - first_step[:, self.pipe.token_id_B], atol=1e-5
+            )
+            assert [score > 0 for score in scores.tolist()] == [verdict == "A" for verdict in generated]
+            # the margin of a pair averages both orderings
+            margins = self.pipe(convs_a, convs_b, output_logits=True, batch_size=1)
+            assert torch.allclose(torch.tensor(margins), (scores[0::2] - scores[1::2]) / 2, atol=1e-5)
+
+            verdicts += generated
+            # swap the A and B logits, so both verdicts are covered
+            with torch.no_grad():
+                model.lm_head.weight.neg_()
+        assert set(verdicts) == {"A", "B"}
@@ -0,0 +1,46 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import torch
+
+from rewardbench.prefetch import BatchPrefetcher
+
+
+class BatchPrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = [
+            {"input_ids": torch.arange(i, i + 4).view(2, 2), "prompt": [f"prompt {i}", f"prompt {i + 1}"]}
+            for i in range(10)
+        ]
+
+    def test_batches_unchanged_and_in_order(self):
+        prefetched = list(BatchPrefetcher(self.batches, device="cpu", num_prefetch=3))
+        assert len(prefetched) == len(self.batches)
+        for batch, expected in zip(prefetched, self.batches):
+            assert torch.equal(batch["input_ids"], expected["input_ids"])
+            assert batch["prompt"] == expected["prompt"]
+
+    def test_stop_early(self):
+        for step, _ in enumerate(BatchPrefetcher(self.batches, num_prefetch=1)):
+            if step == 2:
+                break
+
+    def test_error_is_raised(self):
+        def failing_loader():
+            yield self.batches[0]
+            raise ValueError("collate failed")
+
+        with self.assertRaises(ValueError):
+            list(BatchPrefetcher(failing_loader()))
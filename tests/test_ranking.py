@@ -0,0 +1,39 @@
+# Copyright 2023 AllenAI. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from rewardbench.ranking import knockout_tournament
+
+
+class KnockoutTournamentTest(unittest.TestCase):
+    def setUp(self):
+        self.num_comparisons = 0
+
+    def compare(self, candidates_A, candidates_B):
+        self.num_comparisons += len(candidates_A)
+        return [a > b for a, b in zip(candidates_A, candidates_B)]
+
+    def test_selects_best_of_n(self):
+        groups = [[3, 9, 1, 4, 7], [2], [5, 8, 6, 0, 1, 3, 4, 2], [1, 0, 2]]
+        wins = knockout_tournament(groups, self.compare, batch_size=3)
+
+        for group, group_wins in zip(groups, wins):
+            best = group.index(max(group))
+            assert group_wins[best] == max(group_wins)
+            assert group_wins.count(max(group_wins)) == 1
+
+    def test_linear_number_of_comparisons(self):
+        groups = [list(range(16)), list(range(7))]
+        _ = knockout_tournament(groups, self.compare)
+        assert self.num_comparisons == 15 + 6
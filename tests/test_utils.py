@@ -12,9 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import json
+import tempfile
 import unittest
 
 from rewardbench import save_to_hub
+from rewardbench.utils import (
+    deduplicate_texts,
+    load_shards,
+    save_shard,
+    shard_indices,
+)
 
 
 class SaveDataTest(unittest.TestCase):
@@ -42,3 +49,33 @@ class SaveDataTest(unittest.TestCase):
         self.assertAlmostEqual(output["alpacaeval-easy"], 0.12345, places=5)
         self.assertAlmostEqual(output["math-prm"], 0.54321, places=5)
         # accounts for weird json float conversion
+
+
+class DeduplicateTextsTest(unittest.TestCase):
+    def test_scatter_back(self):
+        texts = ["a", "b", "a", "c", "b", "a"]
+        unique_texts, inverse = deduplicate_texts(texts)
+        assert unique_texts == ["a", "b", "c"]
+        assert [unique_texts[i] for i in inverse] == texts
+
+
+class ShardTest(unittest.TestCase):
+    def test_shards_partition_dataset(self):
+        shards = [shard_indices(10, 3, i) for i in range(3)]
+        assert shards == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+
+    def test_groups_stay_together(self):
+        group_keys = ["a", "a", "b", "c", "b", "c", "d"]
+        shards = [shard_indices(len(group_keys), 2, i, group_keys=group_keys) for i in range(2)]
+        assert shards == [[0, 1, 2, 4], [3, 5, 6]]
+
+    def test_merge_restores_order(self):
+        rows = {"id": list(range(7)), "results": [1, 0, 1, 1, 0, 0, 1]}
+        with tempfile.TemporaryDirectory() as shard_dir:
+            for i in range(3):
+                shard = shard_indices(7, 3, i)
+                shard_rows = {key: [values[j] for j in shard] for key, values in rows.items()}
+                save_shard(shard_rows, shard, shard_dir, i, 3, {"model": "fake/fake_model"})
+            merged, metadata = load_shards(shard_dir, 3)
+        assert merged == rows
+        assert metadata["model"] == "fake/fake_model"